@@ -0,0 +1,60 @@
+'''
+Example: python ./examples/ipdb_readonly.py [10000 50000 100000]
+
+Compare IPDB startup time and memory usage in the default
+and the read-only modes. To not create real interfaces,
+the database is loaded with synthetic RTM_NEWLINK messages,
+cloned from the loopback interface; message parsing is not
+accounted, as it is the same for both modes.
+
+Requires Python 3 (tracemalloc).
+'''
+import gc
+import sys
+import time
+import tracemalloc
+from pyroute2 import IPDB
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+
+BASE = 0x100000
+
+
+def links(template, count):
+    ret = []
+    for x in range(count):
+        dev = ifinfmsg()
+        dev.update(template)
+        dev['index'] = BASE + x
+        dev['attrs'] = [[name, value] for (name, value)
+                        in template['attrs'] if name != 'IFLA_IFNAME']
+        dev['attrs'].append(['IFLA_IFNAME', 'bench%i' % x])
+        dev['event'] = 'RTM_NEWLINK'
+        ret.append(dev)
+    return ret
+
+
+def bench(mode, count):
+    ip = IPDB(mode=mode)
+    try:
+        devs = links(ip.nl.get_links(1)[0], count)
+        gc.collect()
+        tracemalloc.start()
+        start = time.time()
+        with ip.lock:
+            ip.update_links(devs)
+            ip.update_slaves(devs)
+        spent = time.time() - start
+        (size, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return (spent, size)
+    finally:
+        ip.release()
+
+
+counts = [int(x) for x in sys.argv[1:]] or [10000, 50000, 100000]
+print('%10s %10s %10s %12s' % ('mode', 'links', 'time, s', 'memory, MB'))
+for count in counts:
+    for mode in ('implicit', 'readonly'):
+        (spent, size) = bench(mode, count)
+        print('%10s %10i %10.2f %12.1f' % (mode, count, spent,
+                                           size / 1024.0 / 1024.0))
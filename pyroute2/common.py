@@ -3,6 +3,9 @@ Common utilities
 '''
 import re
 import sys
+import time
+import heapq
+import threading
 
 try:
     basestring = basestring
@@ -137,3 +140,103 @@ def hexdump(payload, length=0):
     else:
         return ':'.join('{0:02x}'.format(ord(c))
                         for c in payload[:length] or payload)
+
+
+class Coalescer(object):
+    '''
+    Call `callback(key, data)` not more often than once per
+    `window` seconds for every key. Data of calls that come
+    within the window are merged with `merge(old, new)` -- by
+    default the latest data wins -- and delivered at the end
+    of the window from a separate thread::
+
+        def cb(key, msg):
+            print(key, msg)
+
+        c = Coalescer(cb, 0.5)
+        c.push(1, 'a')  # cb(1, 'a') is called immediately
+        c.push(1, 'b')  # delayed
+        c.push(1, 'c')  # cb(1, 'c') is called in 0.5s
+
+    The thread runs only while there are pending calls.
+    '''
+    def __init__(self, callback, window, merge=None):
+        self.callback = callback
+        self.window = window
+        self.merge = merge or (lambda old, new: new)
+        self.lock = threading.Condition()
+        self.last = {}      # {key: last call time}
+        self.pending = {}   # {key: data}
+        self.queue = []     # heap of (deadline, serial, key)
+        self.serial = 0
+        self.thread = None
+        self.stats = {'calls': 0, 'delivered': 0}
+
+    def push(self, key, data):
+        with self.lock:
+            self.stats['calls'] += 1
+            if key in self.pending:
+                self.pending[key] = self.merge(self.pending[key], data)
+                return
+            now = time.time()
+            last = self.last.get(key, None)
+            if last is not None and now - last < self.window:
+                self.pending[key] = data
+                self.serial += 1
+                heapq.heappush(self.queue,
+                               (last + self.window, self.serial, key))
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run)
+                    self.thread.setDaemon(True)
+                    self.thread.start()
+                self.lock.notify()
+                return
+            self.last[key] = now
+            self.stats['delivered'] += 1
+        self.callback(key, data)
+
+    def flush(self):
+        '''
+        Deliver all pending calls now
+        '''
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.queue = []
+            now = time.time()
+            for key in pending:
+                self.last[key] = now
+            self.stats['delivered'] += len(pending)
+        for (key, data) in pending.items():
+            self.callback(key, data)
+
+    def _run(self):
+        try:
+            while True:
+                with self.lock:
+                    now = time.time()
+                    if not self.queue:
+                        # forget keys, that are out of the window
+                        for (key, last) in tuple(self.last.items()):
+                            if now - last >= self.window:
+                                del self.last[key]
+                        self.thread = None
+                        return
+                    (deadline, serial, key) = self.queue[0]
+                    if deadline > now:
+                        self.lock.wait(deadline - now)
+                        continue
+                    heapq.heappop(self.queue)
+                    data = self.pending.pop(key)
+                    self.last[key] = now
+                    self.stats['delivered'] += 1
+                try:
+                    self.callback(key, data)
+                except Exception:
+                    pass
+        finally:
+            # push() starts a new thread only if there is none,
+            # so never leave a dead one registered
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
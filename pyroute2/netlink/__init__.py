@@ -1,6 +1,7 @@
 import threading
 import struct
 import socket
+import errno
 import os
 import io
 
@@ -26,6 +27,8 @@ NLM_F_REQUEST = 1    # It is request message.
 NLM_F_MULTI = 2    # Multipart message, terminated by NLMSG_DONE
 NLM_F_ACK = 4    # Reply with ack, with zero or error code
 NLM_F_ECHO = 8    # Echo this request
+NLM_F_DUMP_INTR = 0x10    # Dump was inconsistent due to sequence change
+NLM_F_DUMP_FILTERED = 0x20    # Dump was filtered as requested
 # Modifiers to GET request
 NLM_F_ROOT = 0x100    # specify tree    root
 NLM_F_MATCH = 0x200    # return all matching
@@ -46,11 +49,22 @@ NLMSG_TRANSPORT = 0xf    # Custom message type for NL as a transport
 NLMSG_MIN_TYPE = 0x10    # < 0x10: reserved control messages
 NLMSG_MAX_LEN = 0xffff  # Max message length
 
+# Netlink socket options
+#
+SOL_NETLINK = 270
+NETLINK_GET_STRICT_CHK = 12    # Strict dump request checks and filtering
+
 mtypes = {1: 'NLMSG_NOOP',
           2: 'NLMSG_ERROR',
           3: 'NLMSG_DONE',
           4: 'NLMSG_OVERRUN'}
 
+# A bare NLMSG_OVERRUN header. The kernel reports the socket
+# buffer overflow as ENOBUFS on recv(), and we translate it
+# into this packet, so the overrun can be routed as a normal
+# broadcast message.
+NLMSG_OVERRUN_PACKET = struct.pack('IHHII', 16, NLMSG_OVERRUN, 0, 0, 0)
+
 IPRCMD_NOOP = 0
 IPRCMD_STOP = 1
 IPRCMD_ACK = 2
@@ -144,5 +158,11 @@ class NetlinkSocket(socket.socket):
 
     def get(self):
         data = io.BytesIO()
-        data.length = data.write(self.recv(16384))
+        try:
+            data.length = data.write(self.recv(32768))
+        except socket.error as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            # some messages are lost, report it
+            data.length = data.write(NLMSG_OVERRUN_PACKET)
         return self.marshal.parse(data)
@@ -1,3 +1,5 @@
+import collections
+import itertools
 import threading
 import select
 import struct
@@ -18,17 +20,88 @@ from pyroute2.netlink import NLMSG_DONE
 from pyroute2.netlink import NLM_F_MULTI
 from pyroute2.netlink import NLM_F_DUMP
 from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink import NLM_F_ACK
+from pyroute2.netlink import NLMSG_NOOP
+from pyroute2.netlink import NLMSG_OVERRUN_PACKET
+from pyroute2.netlink import NetlinkError
 from pyroute2.netlink.iocore import pairPipeSockets
 from pyroute2.netlink.iocore import IOCore
+from pyroute2.netlink.generic import nlmsg
 from pyroute2.netlink.generic import mgmtmsg
 from pyroute2.netlink.generic import envmsg
 from pyroute2.netlink.generic import NETLINK_GENERIC
+from pyroute2.netlink.generic import NLMSG_ALIGN
+from pyroute2.common import Coalescer
 
 try:
     import Queue
 except ImportError:
     import queue as Queue
 _QUEUE_MAXSIZE = 4096
+# max payload of one transport envelope with a batch of
+# messages; IPR_ATTR_CDATA length is 16 bit, so it must
+# not exceed 64k
+_BATCH_MAXSIZE = 32768
+
+
+def window_key(msg):
+    '''
+    Default identity of the object, that an rtnl message
+    refers to, for callback windows: routes -- by table,
+    prefix, metric and nexthop, neighbors -- by interface
+    and destination (or lladdr for FDB), addresses -- by
+    interface and address, tc objects -- by interface and
+    handle, links -- by interface. Other messages return
+    None and are not coalesced.
+
+    The message type is not a part of the key, so NEW and
+    DEL messages for one object share the slot, and the
+    latest one wins.
+    '''
+    if 'dst_len' in msg:
+        return (msg['family'],
+                msg.get_attr('RTA_TABLE') or msg['table'],
+                msg.get_attr('RTA_DST'),
+                msg['dst_len'],
+                msg['tos'],
+                msg.get_attr('RTA_PRIORITY'),
+                msg.get_attr('RTA_OIF'),
+                msg.get_attr('RTA_GATEWAY'))
+    elif 'ifindex' in msg:
+        dst = msg.get_attr('NDA_DST')
+        return (msg['family'],
+                msg['ifindex'],
+                dst,
+                msg.get_attr('NDA_LLADDR') if dst is None else None)
+    elif 'prefixlen' in msg:
+        return (msg['family'],
+                msg['index'],
+                msg.get_attr('IFA_ADDRESS'),
+                msg['prefixlen'])
+    elif 'handle' in msg:
+        return (msg['index'], msg['handle'], msg['parent'])
+    elif 'index' in msg:
+        return (msg['index'], )
+    return None
+
+
+class DumpFlight(object):
+    '''
+    Dump request in progress, that is shared by several
+    nlm_request() callers.
+    '''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.sent = False
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return list(self.result)
 
 
 class Netlink(threading.Thread):
@@ -65,15 +138,28 @@ class Netlink(threading.Thread):
         self.default_realm = 0
         self.realms = set()     # set(addr, addr, ...)
         self.listeners = {}     # {nonce: Queue(), ...}
-        self.callbacks = []     # [(predicate, callback, args), ...]
+        self.callbacks = []     # [(predicate, callback, args, cb), ...]
         self.debug = debug
         self.cid = None
+        self._sub_refs = 0
+        self.coalesce = True
+        self.coalesce_stats = {'dumps': 0, 'hits': 0}
+        self._flights = {}      # {request key: DumpFlight(), ...}
+        self._flights_lock = threading.Lock()
+        # the kernel allows only one dump at once per socket
+        self._dump_locks = collections.defaultdict(threading.Lock)
+        self._sub_lock = threading.Lock()
         self._nonce = 0
         self._nonce_lock = threading.Lock()
         self.marshal.debug = debug
         self.marshal = self.marshal()
         self.buffers = Queue.Queue()
         self._mirror = False
+        self._no_mirror = set()  # set(nonce, nonce, ...)
+        self._overrun = False
+        self._noack = False
+        self._noack_pending = {}  # {nonce: (realm, msg), ...}
+        self._noack_errors = {}   # {nonce: error, ...}
         self.host = host or 'netlink://%i:%i' % (self.family, self.groups)
         self._run_event = threading.Event()
         self._stop_event = threading.Event()
@@ -104,7 +190,6 @@ class Netlink(threading.Thread):
             except:
                 continue
             for fd in rlist:
-                data = io.BytesIO()
                 try:
                     data = fd.recv()
                 except:
@@ -117,55 +202,42 @@ class Netlink(threading.Thread):
         '''
         Background thread to feed reassembled buffers to the parser
         '''
-        save = None
+        save = b''
         while True:
-            buf = io.BytesIO()
-            buf.length = buf.write(self.buffers.get())
+            data = self.buffers.get()
             if self._stop_event.is_set():
                 return
 
-            buf.seek(0)
-
-            if save is not None:
+            if save:
                 # concatenate buffers
-                buf.seek(0)
-                save.write(buf.read())
-                save.length += buf.length
-                # discard save
-                buf = save
-                save = None
+                data = save + data
+                save = b''
 
             offset = 0
-            while offset < buf.length:
-                buf.seek(offset)
+            total = len(data)
+            while offset < total:
+                if total - offset < 28:
+                    # incomplete envelope header
+                    save = data[offset:]
+                    break
+
+                # envelope header: nlmsg header, dst, src and
+                # IPR_ATTR_CDATA header; decode it w/o envmsg(),
+                # that is too expensive for the data path
                 (length,
                  mtype,
-                 flags) = struct.unpack('IHH', buf.read(8))
+                 flags,
+                 nonce) = struct.unpack_from('IHHI', data, offset)
 
-                if offset + length > buf.length:
+                if offset + length > total:
                     # create save buffer
-                    buf.seek(offset)
-                    save = io.BytesIO()
-                    save.length = save.write(buf.read())
-                    # truncate the buffer
-                    buf.truncate(offset)
+                    save = data[offset:]
                     break
 
-                buf.seek(offset)
-                data = io.BytesIO()
-                data.write(buf.read(length))
-                data.length = length
-                data.seek(0)
-
-                # data traffic
-                envelope = envmsg(data)
-                envelope.decode()
-                nonce = envelope['header']['sequence_number']
+                (nla_length, ) = struct.unpack_from('H', data, offset + 24)
+                buf = io.BytesIO(data[offset + 28:offset + 24 + nla_length])
+                buf.length = nla_length - 4
                 try:
-                    buf = io.BytesIO()
-                    buf.length = buf.write(envelope.
-                                           get_attr('IPR_ATTR_CDATA'))
-                    buf.seek(0)
                     if flags == 1:
                         msg = mgmtmsg(buf)
                         msg.decode()
@@ -190,29 +262,56 @@ class Netlink(threading.Thread):
                 if cr[0](msg):
                     cr[1](msg, *cr[2])
 
+            # 8<--------------------------------------------------------------
+            # errors for requests sent w/o NLM_F_ACK
+            if key in self._noack_pending:
+                error = msg['header'].get('error', None)
+                if error is not None:
+                    self._noack_errors[key] = error
+                continue
+
             # 8<--------------------------------------------------------------
             if key not in self.listeners:
                 key = 0
 
-            if self._mirror and (key != 0) and (msg.raw is not None):
+            if self._mirror and (key != 0) and (msg.raw is not None) and \
+                    (key not in self._no_mirror):
                 # On Python 2.6 it can fail due to class fabrics
                 # in nlmsg definitions, so parse it again. It should
                 # not be much slower than copy.deepcopy()
-                try:
-                    raw = io.BytesIO()
-                    raw.length = raw.write(msg.raw)
-                    self.listeners[0].put_nowait(self.marshal.parse(raw)[0])
-                except Queue.Full:
-                    # FIXME: log this
-                    pass
+                raw = io.BytesIO()
+                raw.length = raw.write(msg.raw)
+                self._put_event(self.marshal.parse(raw)[0])
 
-            if key in self.listeners:
+            if key == 0:
+                self._put_event(msg)
+            elif key in self.listeners:
                 try:
                     self.listeners[key].put_nowait(msg)
                 except Queue.Full:
                     # FIXME: log this
                     pass
 
+    def _put_event(self, msg):
+        '''
+        Put a message into the default 0 queue. When the queue
+        is full, the message is dropped and NLMSG_OVERRUN will be
+        enqueued as soon as there will be room for it, just like
+        the kernel reports socket buffer overflows.
+        '''
+        queue = self.listeners.get(0, None)
+        if queue is None:
+            return
+        try:
+            if self._overrun:
+                raw = io.BytesIO()
+                raw.length = raw.write(NLMSG_OVERRUN_PACKET)
+                queue.put_nowait(self.marshal.parse(raw)[0])
+                self._overrun = False
+            queue.put_nowait(msg)
+        except Queue.Full:
+            self._overrun = True
+
     def command(self, cmd, attrs=[], expect=None):
         msg = mgmtmsg(io.BytesIO())
         msg['cmd'] = cmd
@@ -279,6 +378,53 @@ class Netlink(threading.Thread):
         self.monitor(operate)
         self._mirror = operate
 
+    def noack(self, operate=True):
+        '''
+        Turn ack-less mode on/off. In this mode requests, that
+        should be acknowledged, are sent w/o NLM_F_ACK, and
+        nlm_request() returns w/o waiting for response. The
+        kernel replies only on errors, and they are collected
+        by sequence numbers until the next barrier() call.
+
+        Dump requests are not affected.
+
+        Turning the mode off implies barrier(); the result
+        is returned.
+        '''
+        if operate:
+            self._noack = True
+            return []
+        self._noack = False
+        return self.barrier()
+
+    def barrier(self, timeout=None):
+        '''
+        Wait until the kernel processes all the requests,
+        sent in the ack-less mode, and return the list of
+        failed ones as (msg, error) tuples.
+
+        The kernel processes requests from a socket in order,
+        so an acknowledged NLMSG_NOOP means that all the
+        previous requests are done, and errors for them, if
+        any, are already received.
+        '''
+        pending = dict(self._noack_pending)
+        realms = set([x[0] for x in pending.values()])
+        for realm in realms or (self.default_realm, ):
+            msg = nlmsg()
+            nonce = self.nonce()
+            self.listeners[nonce] = Queue.Queue(maxsize=_QUEUE_MAXSIZE)
+            self.nlm_push(msg, NLMSG_NOOP, NLM_F_REQUEST | NLM_F_ACK,
+                          0, realm, nonce)
+            self.get(nonce, timeout=timeout)
+        ret = []
+        for nonce in sorted(pending):
+            del self._noack_pending[nonce]
+            error = self._noack_errors.pop(nonce, None)
+            if error is not None:
+                ret.append((pending[nonce][1], error))
+        return ret
+
     def monitor(self, operate=True):
         '''
         Create/destroy the default 0 queue. Netlink socket
@@ -289,20 +435,39 @@ class Netlink(threading.Thread):
         Netlink.monitor(). They can be fetched by
         Netlink.get(0) or just Netlink.get().
         '''
-        if operate and self.cid is None:
+        if operate and 0 not in self.listeners:
             self.listeners[0] = Queue.Queue(maxsize=_QUEUE_MAXSIZE)
-            self.cid = self.command(IPRCMD_SUBSCRIBE,
-                                    [['IPR_ATTR_KEY', {'offset': 8,
-                                                       'key': 0,
-                                                       'mask': 0}]],
-                                    expect='IPR_ATTR_CID')
-        else:
-            self.command(IPRCMD_UNSUBSCRIBE,
-                         [['IPR_ATTR_CID', self.cid]])
-            self.cid = None
+            self._subscribe()
+        elif not operate and 0 in self.listeners:
+            self._unsubscribe()
             del self.listeners[0]
 
-    def register_callback(self, callback, predicate=lambda x: True, args=None):
+    def _subscribe(self):
+        '''
+        Subscribe to broadcast messages. The subscription
+        is shared by all the users (the default 0 queue,
+        caches etc.) and is counted by references.
+        '''
+        with self._sub_lock:
+            if self._sub_refs == 0:
+                self.cid = self.command(IPRCMD_SUBSCRIBE,
+                                        [['IPR_ATTR_KEY',
+                                          {'offset': 8,
+                                           'key': 0,
+                                           'mask': 0}]],
+                                        expect='IPR_ATTR_CID')
+            self._sub_refs += 1
+
+    def _unsubscribe(self):
+        with self._sub_lock:
+            self._sub_refs -= 1
+            if self._sub_refs == 0:
+                self.command(IPRCMD_UNSUBSCRIBE,
+                             [['IPR_ATTR_CID', self.cid]])
+                self.cid = None
+
+    def register_callback(self, callback, predicate=lambda x: True, args=None,
+                          window=None, key=None):
         '''
         Register a callback to run on a message arrival.
 
@@ -335,10 +500,33 @@ class Netlink(threading.Thread):
         Please note: you do **not** need to register the default 0 queue
         to invoke callbacks on broadcast messages. Callbacks are
         iterated **before** messages get enqueued.
+
+        With `window` (seconds) the callback is called not more
+        often than once per window for every object, and only
+        with the latest message; the rest are dropped. Objects
+        are identified by `key(msg)`, see `window_key()` for
+        the default; messages with the key None are passed
+        through w/o delays::
+
+            # not more than one call per 100ms per object
+            ipr.register_callback(cb, window=0.1)
         '''
         if args is None:
             args = []
-        self.callbacks.append((predicate, callback, args))
+        origin = callback
+        if window is not None:
+            key = key or window_key
+            coalescer = Coalescer(lambda k, msg: origin(msg, *args),
+                                  window)
+
+            def callback(msg, *argv):
+                k = key(msg)
+                if k is None:
+                    origin(msg, *args)
+                else:
+                    coalescer.push(k, msg)
+
+        self.callbacks.append((predicate, callback, args, origin))
 
     def unregister_callback(self, callback):
         '''
@@ -347,7 +535,7 @@ class Netlink(threading.Thread):
         '''
         cb = tuple(self.callbacks)
         for cr in cb:
-            if cr[1] == callback:
+            if cr[3] == callback:
                 self.callbacks.pop(cb.index(cr))
                 return
 
@@ -419,13 +607,11 @@ class Netlink(threading.Thread):
                  env_flags=None,
                  realm=0,
                  nonce=0):
-        msg['header']['sequence_number'] = nonce
-        msg['header']['pid'] = os.getpid()
-        if msg_type is not None:
-            msg['header']['type'] = msg_type
-        if msg_flags is not None:
-            msg['header']['flags'] = msg_flags
-        msg.encode()
+        self.nlm_push_batch(((msg, msg_type, msg_flags, nonce), ),
+                            env_flags,
+                            realm)
+
+    def _push_envelope(self, data, nonce, env_flags, realm):
         envelope = envmsg()
         envelope['header']['sequence_number'] = nonce
         envelope['header']['pid'] = os.getpid()
@@ -434,28 +620,229 @@ class Netlink(threading.Thread):
             envelope['header']['flags'] = env_flags
         envelope['dst'] = realm
         envelope['src'] = 0
-        envelope['attrs'] = [['IPR_ATTR_CDATA', msg.buf.getvalue()]]
+        envelope['attrs'] = [['IPR_ATTR_CDATA', data]]
         envelope.encode()
         self.bridge.send(envelope.buf.getvalue())
 
+    def nlm_push_batch(self, msgs, env_flags=None, realm=0):
+        '''
+        Send several messages with as few envelopes as
+        possible. The kernel processes all the messages
+        in a datagram one by one, so one syscall serves
+        the whole batch.
+
+        * msgs -- iterable of (msg, msg_type, msg_flags, nonce)
+        '''
+        chunk = []
+        size = 0
+        first = None
+        pid = os.getpid()
+        for (msg, msg_type, msg_flags, nonce) in msgs:
+            msg['header']['sequence_number'] = nonce
+            msg['header']['pid'] = pid
+            if msg_type is not None:
+                msg['header']['type'] = msg_type
+            if msg_flags is not None:
+                msg['header']['flags'] = msg_flags
+            msg.encode()
+            data = msg.buf.getvalue()
+            data += b'\0' * (NLMSG_ALIGN(len(data)) - len(data))
+            if chunk and size + len(data) > _BATCH_MAXSIZE:
+                self._push_envelope(b''.join(chunk), first,
+                                    env_flags, realm)
+                chunk = []
+                size = 0
+            if not chunk:
+                first = nonce
+            chunk.append(data)
+            size += len(data)
+        if chunk:
+            self._push_envelope(b''.join(chunk), first, env_flags, realm)
+
     def nlm_request(self, msg, msg_type,
                     msg_flags=NLM_F_DUMP | NLM_F_REQUEST,
                     env_flags=0,
                     realm=None,
-                    response_timeout=None):
+                    response_timeout=None,
+                    mirror=True,
+                    nonce=None):
         '''
         Send netlink request, filling common message
         fields, and wait for response.
+
+        With mirror=False the response will not be copied
+        into the default 0 queue, even if mirroring is on.
+
+        The `nonce` can be allocated in advance with nonce():
+        mirrored responses keep it as the sequence number, so
+        the consumer of the 0 queue can correlate them with
+        the request.
+
+        The kernel runs only one dump at once per socket, so
+        dump requests are serialized. Concurrent identical dump
+        requests are coalesced: only the first one is sent to
+        the kernel, and others wait for its result. A request
+        joins only a dump that is not sent yet, so it never
+        gets a result older than the request itself. Every
+        caller gets its own list, but the messages are shared
+        and should not be modified. Set `coalesce` to False to
+        turn it off; hits are counted in `coalesce_stats`.
         '''
         # FIXME make it thread safe, yeah
         realm = realm or self.default_realm
-        nonce = self.nonce()
+        if self.coalesce and (msg_flags & NLM_F_DUMP) == NLM_F_DUMP and \
+                nonce is None:
+            key = (msg_type, msg_flags, env_flags, realm, mirror,
+                   msg.__class__.__name__,
+                   repr([msg.get(x[0]) for x in msg.fields]),
+                   repr(msg.get('attrs')))
+            with self._flights_lock:
+                flight = self._flights.get(key, None)
+                # a flight that is already sent can miss changes
+                # made by the caller before this request, so do
+                # not join it, but queue a new one behind it
+                leader = flight is None or flight.sent
+                if leader:
+                    flight = self._flights[key] = DumpFlight()
+                    self.coalesce_stats['dumps'] += 1
+                else:
+                    self.coalesce_stats['hits'] += 1
+            if not leader:
+                return flight.wait()
+            try:
+                with self._dump_locks[realm]:
+                    with self._flights_lock:
+                        flight.sent = True
+                    flight.result = self._nlm_request(msg, msg_type,
+                                                      msg_flags,
+                                                      env_flags,
+                                                      realm,
+                                                      response_timeout,
+                                                      mirror)
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self._flights_lock:
+                    if self._flights.get(key, None) is flight:
+                        del self._flights[key]
+                flight.event.set()
+            return list(flight.result)
+        if (msg_flags & NLM_F_DUMP) == NLM_F_DUMP:
+            with self._dump_locks[realm]:
+                return self._nlm_request(msg, msg_type, msg_flags,
+                                         env_flags, realm,
+                                         response_timeout, mirror,
+                                         nonce)
+        return self._nlm_request(msg, msg_type, msg_flags, env_flags,
+                                 realm, response_timeout, mirror, nonce)
+
+    def _nlm_request(self, msg, msg_type, msg_flags, env_flags,
+                     realm, response_timeout, mirror, nonce=None):
+        nonce = nonce or self.nonce()
+        if self._noack and (msg_flags & NLM_F_ACK) and \
+                (msg_flags & NLM_F_DUMP) != NLM_F_DUMP:
+            # ack-less mode: do not wait, errors will be
+            # reported by barrier()
+            self._noack_pending[nonce] = (realm, msg)
+            self.nlm_push(msg, msg_type, msg_flags & ~NLM_F_ACK,
+                          env_flags, realm, nonce)
+            return []
         self.listeners[nonce] = Queue.Queue(maxsize=_QUEUE_MAXSIZE)
-        self.nlm_push(msg, msg_type, msg_flags, env_flags, realm, nonce)
-        result = self.get(nonce, timeout=response_timeout)
+        if not mirror:
+            self._no_mirror.add(nonce)
+        try:
+            self.nlm_push(msg, msg_type, msg_flags, env_flags, realm, nonce)
+            result = self.get(nonce, timeout=response_timeout)
+        finally:
+            self._no_mirror.discard(nonce)
         for msg in result:
             # reset message buffer, make it ready for encoding back
             msg.reset()
             if not self.debug:
                 del msg['header']
         return result
+
+    def nlm_request_batch(self, msgs,
+                          env_flags=0,
+                          realm=None,
+                          response_timeout=None,
+                          mirror=True,
+                          window=128):
+        '''
+        Send a batch of netlink requests and wait for all
+        the responses.
+
+        * msgs -- iterable of (msg, msg_type, msg_flags)
+        * window -- max number of requests in flight
+
+        Requests are pushed in chunks, keeping not more than
+        `window` requests without response: the kernel drops
+        responses (ENOBUFS), if the socket buffer overflows.
+
+        Returns the list of results in the order of requests.
+        Every result is either the list of response messages,
+        or the exception (NetlinkError or Queue.Empty on
+        timeout), so errors can be mapped back to the
+        originating requests. Modifying requests should be
+        sent with NLM_F_ACK, otherwise there will be no
+        response to wait for.
+        '''
+        return list(self.nlm_request_iter(msgs,
+                                          env_flags,
+                                          realm,
+                                          response_timeout,
+                                          mirror,
+                                          window))
+
+    def nlm_request_iter(self, msgs,
+                         env_flags=0,
+                         realm=None,
+                         response_timeout=None,
+                         mirror=True,
+                         window=128):
+        '''
+        The same as nlm_request_batch(), but yields results
+        one by one, as soon as they are received. The input
+        iterable is consumed lazily, so it is possible to
+        stream any number of requests w/o keeping them all
+        in memory.
+        '''
+        realm = realm or self.default_realm
+        msgs = iter(msgs)
+        pending = collections.deque()
+        try:
+            while True:
+                # refill the window, when it is half-empty
+                if len(pending) <= window // 2:
+                    chunk = []
+                    for (msg, msg_type, msg_flags) in \
+                            itertools.islice(msgs, window - len(pending)):
+                        nonce = self.nonce()
+                        self.listeners[nonce] = \
+                            Queue.Queue(maxsize=_QUEUE_MAXSIZE)
+                        if not mirror:
+                            self._no_mirror.add(nonce)
+                        chunk.append((msg, msg_type, msg_flags, nonce))
+                    pending.extend(chunk)
+                    if chunk:
+                        self.nlm_push_batch(chunk, env_flags, realm)
+                if not pending:
+                    break
+                nonce = pending[0][3]
+                try:
+                    result = self.get(nonce, timeout=response_timeout)
+                    for msg in result:
+                        msg.reset()
+                        if not self.debug:
+                            del msg['header']
+                except (NetlinkError, Queue.Empty) as e:
+                    result = e
+                finally:
+                    self._no_mirror.discard(nonce)
+                    pending.popleft()
+                yield result
+        finally:
+            for (msg, msg_type, msg_flags, nonce) in pending:
+                self._no_mirror.discard(nonce)
+                self.listeners.pop(nonce, None)
@@ -1,8 +1,10 @@
+import collections
 import traceback
 import threading
 import select
 import socket
 import struct
+import errno
 import time
 import os
 import io
@@ -12,9 +14,16 @@ import ssl
 
 from pyroute2.common import AF_PIPE
 from pyroute2.netlink import NetlinkSocket
+from pyroute2.netlink import SOL_NETLINK
+from pyroute2.netlink import NETLINK_GET_STRICT_CHK
 from pyroute2.netlink import NLMSG_NOOP
+from pyroute2.netlink import NLMSG_DONE
+from pyroute2.netlink import NLMSG_ERROR
+from pyroute2.netlink import NLM_F_ACK
+from pyroute2.netlink import NLM_F_DUMP
 from pyroute2.netlink import NLMSG_CONTROL
 from pyroute2.netlink import NLMSG_TRANSPORT
+from pyroute2.netlink import NLMSG_OVERRUN_PACKET
 from pyroute2.netlink import IPRCMD_ERR
 from pyroute2.netlink import IPRCMD_STOP
 from pyroute2.netlink import IPRCMD_ACK
@@ -29,6 +38,8 @@ from pyroute2.netlink import IPRCMD_REGISTER
 from pyroute2.netlink.generic import mgmtmsg
 from pyroute2.netlink.generic import nlmsg
 from pyroute2.netlink.generic import envmsg
+from pyroute2.netlink.generic import NLMSG_ALIGN
+from pyroute2.netlink.generic import NETLINK_ROUTE
 
 try:
     import urlparse
@@ -173,6 +184,12 @@ def _repr_sockets(sockets, mode):
     return ret
 
 
+def _tobytes(data):
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
 class PipeSocket(object):
     '''
     Socket-like object for one-system IPC.
@@ -186,14 +203,41 @@ class PipeSocket(object):
     def __init__(self, rfd, wfd):
         self.rfd = rfd
         self.wfd = wfd
+        # writes longer than PIPE_BUF are not atomic, so
+        # concurrent senders must not interleave
+        self.lock = threading.Lock()
 
     def send(self, data):
-        os.write(self.wfd, data)
+        with self.lock:
+            os.write(self.wfd, data)
+
+    def sendv(self, buffers):
+        '''
+        Send several buffers with one syscall, when possible,
+        w/o concatenating them.
+        '''
+        with self.lock:
+            if hasattr(os, 'writev'):
+                os.writev(self.wfd, buffers)
+            else:
+                os.write(self.wfd,
+                         b''.join([_tobytes(x) for x in buffers]))
+
+    def _read(self, length):
+        # os.read() can return less than requested, if the
+        # message is longer than the pipe buffer
+        ret = os.read(self.rfd, length)
+        while len(ret) < length:
+            chunk = os.read(self.rfd, length - len(ret))
+            if not chunk:
+                break
+            ret += chunk
+        return ret
 
     def recv(self, length=0, flags=0):
-        ret = os.read(self.rfd, 4)
+        ret = self._read(4)
         length = struct.unpack('I', ret)[0]
-        ret += os.read(self.rfd, length - 4)
+        ret += self._read(length - 4)
         return ret
 
     def getsockname(self):
@@ -213,6 +257,83 @@ def pairPipeSockets():
     return PipeSocket(pipe0_r, pipe1_w), PipeSocket(pipe1_r, pipe0_w)
 
 
+class BufferPool(object):
+    '''
+    Pool of preallocated receive buffers. Buffers are taken
+    by the I/O thread and returned back by the routing thread,
+    when the data is sent further.
+
+    The default buffer size is 32k, since the kernel can fill
+    dump skb up to this size, and shorter buffers truncate
+    datagrams.
+    '''
+
+    def __init__(self, size=32768, limit=256):
+        self.size = size
+        self.limit = limit
+        self.pool = []
+
+    def get(self):
+        # list.pop() and list.append() are atomic, so no lock
+        # is required for one producer and one consumer
+        try:
+            return self.pool.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def put(self, buf):
+        if len(self.pool) < self.limit:
+            self.pool.append(buf)
+
+
+class PooledBuffer(object):
+    '''
+    BytesIO-like wrapper for a received datagram in a pooled
+    bytearray. Unlike BytesIO it does not copy the data: write()
+    updates the buffer in place and getvalue() returns a view.
+    '''
+
+    def __init__(self, pool, buf, length):
+        self.pool = pool
+        self.buf = buf
+        self.length = length
+        self.offset = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.offset
+        elif whence == 2:
+            offset += self.length
+        self.offset = offset
+        return offset
+
+    def tell(self):
+        return self.offset
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length - self.offset
+        end = min(self.offset + size, self.length)
+        ret = bytes(self.buf[self.offset:end])
+        self.offset = end
+        return ret
+
+    def write(self, data):
+        end = self.offset + len(data)
+        self.buf[self.offset:end] = data
+        self.offset = end
+        return len(data)
+
+    def getvalue(self):
+        return memoryview(self.buf)[:self.length]
+
+    def release(self):
+        if self.pool is not None:
+            self.pool.put(self.buf)
+        self.pool = None
+        self.buf = None
+
+
 class Layer(object):
 
     def __init__(self, raw):
@@ -241,6 +362,7 @@ class MasqRecord(object):
         self.data = None
         self.socket = socket
         self.ctime = time.time()
+        self.serial = 0
 
     def add_envelope(self, envelope):
         self.envelope = Layer(envelope)
@@ -281,12 +403,19 @@ class IOCore(threading.Thread):
         self._xlist = set()
         # routing
         self.masquerade = {}      # {int: MasqRecord()...}
+        self.unacked = {}         # {realm: deque((int, MasqRecord()))}
+        self._serial = 0
         self.recv_methods = {}    # {socket: recv_method, ...}
+        self.partial = {}         # {socket: incomplete envelope, ...}
         self.clients = set()      # set(socket, socket...)
         self.servers = set()      # set(socket, socket...)
         self.controls = set()     # set(socket, socket...)
         self.subscribe = {}
         self.queue = Queue.Queue(_QUEUE_MAXSIZE)
+        self.pool = BufferPool()
+        # how many datagrams to read from one netlink socket
+        # on one select() wakeup
+        self.recv_batch = 64
         self._cid = list(range(1024))
         self._nonce = list(range(0xffff))
         # secret; write non-zero byte as terminator
@@ -326,7 +455,12 @@ class IOCore(threading.Thread):
         '''
         while not self._stop_event.is_set():
             try:
-                self.route(*self.queue.get())
+                (sock, data) = self.queue.get()
+                try:
+                    self.route(sock, data)
+                finally:
+                    if isinstance(data, PooledBuffer):
+                        data.release()
             except:
                 pass
 
@@ -338,9 +472,17 @@ class IOCore(threading.Thread):
             # expire masquerade records
             ts = time.time()
             for i in tuple(self.masquerade.keys()):
-                if (ts - self.masquerade[i].ctime) > 60:
-                    del self.masquerade[i]
-                    self._nonce.append(i)
+                masq = self.masquerade.get(i, None)
+                if masq is not None and (ts - masq.ctime) > 60:
+                    self.release_masq(i)
+            # drop expired records from the unacked lists
+            for unacked in tuple(self.unacked.values()):
+                for (nonce, masq) in tuple(unacked):
+                    if self.masquerade.get(nonce, None) is not masq:
+                        try:
+                            unacked.remove((nonce, masq))
+                        except ValueError:
+                            pass
             self._stop_event.wait(60)
             if self._stop_event.is_set():
                 return
@@ -431,8 +573,19 @@ class IOCore(threading.Thread):
                     ca = cmd.get_attr('IPR_ATTR_SSL_CA')
                     target = urlparse.urlparse(url)
                     if target.scheme == 'netlink':
-                        new_sock = NetlinkSocket(int(target.hostname))
+                        family = int(target.hostname)
+                        new_sock = NetlinkSocket(family)
                         new_sock.bind(int(target.port))
+                        if family == NETLINK_ROUTE:
+                            # ask the kernel to filter dumps by the
+                            # request fields; old kernels do not
+                            # support it, then clients filter
+                            try:
+                                new_sock.setsockopt(SOL_NETLINK,
+                                                    NETLINK_GET_STRICT_CHK,
+                                                    1)
+                            except socket.error:
+                                pass
                         sys = cmd.get_attr('IPR_ATTR_SYS',
                                            self.default_sys[target.scheme])
                         send = lambda d, s:\
@@ -543,13 +696,7 @@ class IOCore(threading.Thread):
             compare = struct.unpack('I', data.read(4))[0]
             if compare & mask != key:
                 return
-        # envelope data
-        envelope = envmsg()
-        envelope['header']['type'] = NLMSG_TRANSPORT
-        envelope['attrs'] = [['IPR_ATTR_CDATA',
-                              data.getvalue()]]
-        envelope.encode()
-        u32['socket'].send(envelope.buf.getvalue())
+        self.send_envelope(u32['socket'], data)
 
     def route_local(self, sock, data, seq):
         # extract masq info
@@ -559,31 +706,77 @@ class IOCore(threading.Thread):
                 self.filter_u32(u32, data)
         else:
             offset = 0
+            final = False
             while offset < data.length:
                 data.seek(offset)
                 (length,
                  mtype,
-                 flags,
-                 seq,
-                 pid) = struct.unpack('IHHII', data.read(16))
-                data.seek(offset + 8)
+                 flags) = struct.unpack('IHH', data.read(8))
                 data.write(struct.pack('II',
                                        target.data.nonce,
                                        target.data.pid))
+                # NLMSG_ERROR (incl. ACK) and NLMSG_DONE are
+                # the last messages for the request
+                final = mtype in (NLMSG_ERROR, NLMSG_DONE)
                 # skip to the next in chunk
-                offset += length
-            # envelope data
-            envelope = envmsg()
-            envelope['header']['sequence_number'] = target.envelope.nonce
-            envelope['header']['pid'] = target.envelope.pid
-            envelope['header']['type'] = NLMSG_TRANSPORT
-            envelope['dst'] = target.src
-            envelope['src'] = target.dst
-            envelope['attrs'] = [['IPR_ATTR_CDATA',
-                                  data.getvalue()]]
-            envelope.encode()
-            # target
-            target.socket.send(envelope.buf.getvalue())
+                offset += length or data.length
+            self.send_envelope(target.socket, data,
+                               nonce=target.envelope.nonce,
+                               pid=target.envelope.pid,
+                               dst=target.src,
+                               src=target.dst)
+            if final:
+                self.release_masq(seq, final=True)
+
+    def release_masq(self, nonce, final=False):
+        '''
+        Drop the masquerade record and return the nonce back
+        to the pool. Without it bulk operations could exhaust
+        the pool before records expire.
+
+        The kernel processes requests from one socket in order,
+        so the final response to a request means that all the
+        requests w/o NLM_F_ACK sent before got their responses,
+        if any. With `final=True` release them as well.
+        '''
+        masq = self.masquerade.pop(nonce, None)
+        if masq is None:
+            return
+        self._nonce.append(nonce)
+        if not final:
+            return
+        unacked = self.unacked.get(masq.dst, None)
+        while unacked and unacked[0][1].serial < masq.serial:
+            (prev, record) = unacked.popleft()
+            if self.masquerade.get(prev, None) is record:
+                del self.masquerade[prev]
+                self._nonce.append(prev)
+
+    def send_envelope(self, sock, data, nonce=0, pid=0, dst=0, src=0):
+        '''
+        Wrap the data into a transport envelope and send it.
+
+        The envelope header is packed manually, so the payload
+        is not copied, if the socket supports vectored send.
+        '''
+        payload = data.getvalue()
+        length = len(payload)
+        pad = b'\0' * (NLMSG_ALIGN(length) - length)
+        # nlmsg header, dst, src, IPR_ATTR_CDATA header
+        header = struct.pack('IHHIIIIHH',
+                             28 + length + len(pad),
+                             NLMSG_TRANSPORT,
+                             0,
+                             nonce,
+                             pid,
+                             dst,
+                             src,
+                             4 + length,
+                             0)
+        if hasattr(sock, 'sendv'):
+            sock.sendv([header, payload, pad])
+        else:
+            sock.send(b''.join((header, _tobytes(payload), pad)))
 
     def route(self, sock, data):
         """
@@ -611,6 +804,58 @@ class IOCore(threading.Thread):
         ret += buf.write(fd.recv(16384))
         return ret, {}
 
+    def reassemble(self, fd, data):
+        '''
+        Split the data, received from a stream connection, into
+        envelopes. One recv() can return several envelopes, e.g.
+        responses to a batch, or only a part of one; the tail is
+        saved till the next recv() from the socket.
+        '''
+        data = self.partial.pop(fd, b'') + data.getvalue()
+        total = len(data)
+        offset = 0
+        ret = []
+        while total - offset >= 4:
+            (length, ) = struct.unpack_from('I', data, offset)
+            if length < 16:
+                # broken stream, drop the rest
+                return ret
+            if offset + length > total:
+                break
+            envelope = io.BytesIO(data[offset:offset + length])
+            envelope.length = length
+            ret.append(envelope)
+            offset += length
+        if offset < total:
+            self.partial[fd] = data[offset:]
+        return ret
+
+    def recv_netlink(self, fd):
+        '''
+        Read all pending datagrams from a netlink socket, up to
+        `recv_batch`, into pooled buffers and enqueue them for
+        routing.
+        '''
+        for i in range(self.recv_batch):
+            buf = self.pool.get()
+            try:
+                # the first read must not block either: select()
+                # could be woken up by another socket
+                length = fd.recv_into(buf, len(buf), socket.MSG_DONTWAIT)
+            except socket.error as e:
+                self.pool.put(buf)
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # the kernel dropped some messages for the
+                # socket: route NLMSG_OVERRUN to subscribers
+                data = io.BytesIO()
+                data.length = data.write(NLMSG_OVERRUN_PACKET)
+                self.queue.put((fd, data))
+                continue
+            self.queue.put((fd, PooledBuffer(self.pool, buf, length)))
+
     def gate_forward(self, envelope, sock):
         # 1. get data
         data = io.BytesIO(envelope.get_attr('IPR_ATTR_CDATA'))
@@ -632,16 +877,33 @@ class IOCore(threading.Thread):
     def gate_untag(self, envelope, sock):
         # 1. get data
         data = io.BytesIO(envelope.get_attr('IPR_ATTR_CDATA'))
-        # 2. register way back
-        nonce = self._nonce.pop()
+        total = len(data.getvalue())
         src = envelope['src']
         dst = envelope['dst']
-        masq = MasqRecord(dst, src, sock)
-        masq.add_envelope(envelope)
-        masq.add_data(data)
-        self.masquerade[nonce] = masq
-        data.seek(8)
-        data.write(struct.pack('II', nonce, self.pid))
+        # 2. register way back; the envelope can carry a batch
+        # of messages, so tag every message with its own nonce
+        offset = 0
+        while offset + 16 <= total:
+            data.seek(offset)
+            nonce = self._nonce.pop()
+            masq = MasqRecord(dst, src, sock)
+            masq.add_envelope(envelope)
+            masq.add_data(data)
+            self._serial += 1
+            masq.serial = self._serial
+            self.masquerade[nonce] = masq
+            # requests w/o ACK can have no response at all, track
+            # them to release with the next acknowledged one
+            if not (masq.data.flags & NLM_F_ACK) and \
+                    (masq.data.flags & NLM_F_DUMP) != NLM_F_DUMP:
+                if dst not in self.unacked:
+                    self.unacked[dst] = collections.deque()
+                self.unacked[dst].append((nonce, masq))
+            data.seek(offset + 8)
+            data.write(struct.pack('II', nonce, self.pid))
+            if masq.data.length < 16:
+                break
+            offset += NLMSG_ALIGN(masq.data.length)
         # 3. return data
         return data.getvalue()
 
@@ -728,6 +990,7 @@ class IOCore(threading.Thread):
         self._rlist.remove(sock)
         self._wlist.remove(sock)
         self.clients.remove(sock)
+        self.partial.pop(sock, None)
         return sock
 
     def run(self):
@@ -755,6 +1018,17 @@ class IOCore(threading.Thread):
                         traceback.print_exc()
                     continue
 
+                ##
+                #
+                # Netlink sockets: batched receive
+                #
+                if isinstance(fd, NetlinkSocket):
+                    try:
+                        self.recv_netlink(fd)
+                    except (socket.error, OSError):
+                        traceback.print_exc()
+                    continue
+
                 ##
                 #
                 # Receive data from already open connection
@@ -784,7 +1058,8 @@ class IOCore(threading.Thread):
                 # Route the data
                 #
                 try:
-                    self.queue.put((fd, data))
+                    for envelope in self.reassemble(fd, data):
+                        self.queue.put((fd, envelope))
                 except Exception:
                     # FIXME: silently drop all exceptions yet
                     pass
@@ -10,20 +10,48 @@ Quick start:
     ip['eth0']['txqlen'] = 2000
     ip['eth0'].commit()
 '''
+import io
+import os
+import json
+import mmap
+import time
+import struct
 import uuid
+import binascii
+import itertools
 import platform
 import threading
+import collections
 try:
     from Queue import Empty
 except ImportError:
     from queue import Empty
+try:
+    from collections.abc import Set
+except ImportError:
+    from collections import Set
 
 from socket import AF_INET
 from socket import AF_INET6
+from socket import AF_UNSPEC
+from socket import inet_pton
+from socket import inet_ntop
 from pyroute2.common import Dotkeys
+from pyroute2.common import Coalescer
 from pyroute2.netlink import NetlinkError
+from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink.generic import NLMSG_ALIGN
 from pyroute2.netlink.iproute import IPRoute
+from pyroute2.netlink.iproute import RTM_GETLINK
+from pyroute2.netlink.iproute import RTM_GETADDR
+from pyroute2.netlink.iproute import RTM_DELADDR
+from pyroute2.netlink.iproute import RTM_GETROUTE
+from pyroute2.netlink.iproute import RTM_GETNEIGH
+from pyroute2.netlink.iproute import RTEXT_FILTER_SKIP_STATS
 from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+from pyroute2.netlink.rtnl.ifaddrmsg import ifaddrmsg
+from pyroute2.netlink.rtnl.rtmsg import rtmsg
+from pyroute2.netlink.rtnl.ndmsg import ndmsg
 from pyroute2.netlink.rtnl.tcmsg import tcmsg
 
 tc_fields = [tcmsg.nla2name(i[0]) for i in tcmsg.nla_map]
@@ -33,17 +61,75 @@ nla_fields.append('mask')
 nla_fields.append('change')
 nla_fields.append('state')
 nla_fields.append('removal')
+_nla_keys = frozenset(nla_fields)
+# interface items, that are not loaded from RTM_NEWLINK
+_LINK_CLEANUP = ('header',
+                 'linkinfo',
+                 'af_spec',
+                 'attrs',
+                 'event',
+                 'map',
+                 'stats',
+                 'stats64')
 
 
 _ANCIENT_PLATFORM = platform.dist()[:2] == ('redhat', '6.4')
 # How long should we wait on EACH commit() checkpoint: for ipaddr,
 # ports etc. That's not total commit() timeout.
 _SYNC_TIMEOUT = 3
+# max number of events, applied at once by the monitor
+_BATCH_MAXSIZE = 4096
+# max number of bulk commit requests in flight: link changes
+# cause a lot of broadcasts, that share the socket buffer with
+# responses
+_BULK_WINDOW = 32
+# flap penalty half-life, seconds
+_FLAP_HALF_LIFE = 60
 
 _FAIL_COMMIT = 0b00000001
 _FAIL_ROLLBACK = 0b00000010
 _FAIL_MASK = 0b11111111
 
+_IFF_UP = 0x1
+_RTM_F_CLONED = 0x200
+_RT_TABLE_MAIN = 254
+_NUD_NOARP = 0x40
+_NUD_PERMANENT = 0x80
+_ADDR_BITS = {AF_INET: 32,
+              AF_INET6: 128}
+# NLA type w/o NLA_F_NESTED and NLA_F_NET_BYTEORDER
+_NLA_TYPE_MASK = 0x3fff
+_IFLA = dict([(x[0], i) for (i, x) in enumerate(ifinfmsg.nla_map)])
+# NLAs, that are not stored in snapshots
+_SNAPSHOT_SKIP = set([_IFLA[x] for x in ('IFLA_STATS',
+                                         'IFLA_MAP',
+                                         'IFLA_STATS64',
+                                         'IFLA_AF_SPEC')])
+_IFLA_INFO_KIND = 1
+_IFLA_INFO_DATA = 2
+# snapshot verification: ifi_flags bits, that are not reported
+# by /sys/class/net/*/flags or differ there (promisc, allmulti)
+_IFF_VOLATILE = 0x40 | 0x100 | 0x200 | 0x10000 | 0x20000
+_SYSFS_NET = '/sys/class/net'
+# shared snapshot header: sequence, data length
+_SHM_HEADER = struct.Struct('=QQ')
+_SHM_SIZE = 0x10000
+# events, that wake IPDB.wait_for(): {event: index field}
+_WAKE_INDEX = {'RTM_NEWLINK': 'index',
+               'RTM_DELLINK': 'index',
+               'RTM_NEWADDR': 'index',
+               'RTM_DELADDR': 'index',
+               'RTM_NEWNEIGH': 'ifindex',
+               'RTM_DELNEIGH': 'ifindex'}
+# field types, that are published
+_SHM_TYPES = (int, float, str, type(None))
+_SYSFS_FIELDS = (('index', 'ifindex', int),
+                 ('mtu', 'mtu', int),
+                 ('flags', 'flags', lambda x: int(x, 16)),
+                 ('address', 'address', lambda x: x or None),
+                 ('operstate', 'operstate', lambda x: x.upper()),
+                 ('txqlen', 'tx_queue_len', int))
+
 
 def clear_fail_bit(bit):
     global _FAIL_MASK
@@ -60,6 +146,59 @@ def set_ancient(flag):
     _ANCIENT_PLATFORM = flag
 
 
+def get_link_kind(dev):
+    '''
+    Return interface kind fields from RTM_NEWLINK message.
+    '''
+    ret = {}
+    linkinfo = dev.get_attr('IFLA_LINKINFO')
+    if linkinfo is not None:
+        kind = linkinfo.get_attr('IFLA_INFO_KIND')
+        if kind is not None:
+            ret['kind'] = kind
+            if kind == 'vlan':
+                data = linkinfo.get_attr('IFLA_INFO_DATA')
+                ret['vlan_id'] = data.get_attr('IFLA_VLAN_ID')
+    return ret
+
+
+def _nla_chain(data, offset):
+    # iterate (type, raw NLA w/ padding) in a raw NLA chain
+    while offset + 4 <= len(data):
+        (length, nla_type) = struct.unpack('HH', data[offset:offset + 4])
+        if length < 4:
+            break
+        chunk = data[offset:offset + NLMSG_ALIGN(length)]
+        yield (nla_type & _NLA_TYPE_MASK,
+               chunk.ljust(NLMSG_ALIGN(length), b'\0'))
+        offset += NLMSG_ALIGN(length)
+
+
+def strip_link(raw):
+    '''
+    Strip raw RTM_NEWLINK message of NLAs, that are not
+    stored in IPDB: statistics, device map, AF specific
+    data, and link info beside of the kind and vlan data.
+    The result is a valid message, that can be parsed as
+    usual, but much faster.
+    '''
+    chunks = [raw[16:32]]
+    for (nla_type, nla) in _nla_chain(raw, 32):
+        if nla_type in _SNAPSHOT_SKIP:
+            continue
+        if nla_type == _IFLA['IFLA_LINKINFO']:
+            info = dict(_nla_chain(nla, 4))
+            kind = info.get(_IFLA_INFO_KIND, b'')
+            payload = kind
+            if kind[4:].rstrip(b'\0') == b'vlan':
+                payload += info.get(_IFLA_INFO_DATA, b'')
+            nla = struct.pack('HH', len(payload) + 4,
+                              struct.unpack('H', nla[2:4])[0]) + payload
+        chunks.append(nla)
+    body = b''.join(chunks)
+    return struct.pack('I', len(body) + 16) + raw[4:16] + body
+
+
 def get_addr_nla(msg):
     '''
     Incosistency in Linux IP addressing scheme is that
@@ -106,7 +245,8 @@ class LinkedSet(set):
     def add(self, key, raw=None):
         with self.lock:
             if key not in self:
-                self.raw[key] = raw
+                if raw is not None:
+                    self.raw[key] = raw
                 set.add(self, key)
                 for link in self.links:
                     link.add(key, raw)
@@ -115,6 +255,7 @@ class LinkedSet(set):
     def remove(self, key, raw=None):
         with self.lock:
             set.remove(self, key)
+            self.raw.pop(key, None)
             for link in self.links:
                 if key in link:
                     link.remove(key)
@@ -128,6 +269,147 @@ class LinkedSet(set):
         return repr(list(self))
 
 
+class PlainSet(set):
+    '''
+    LinkedSet update API without locks, targets and links,
+    for read-only IPDB.
+    '''
+    def add(self, key, raw=None):
+        set.add(self, key)
+
+    def remove(self, key, raw=None):
+        set.remove(self, key)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def _addr_family(addr):
+    return AF_INET6 if addr.find(':') > -1 else AF_INET
+
+
+class AddressSet(Set):
+    '''
+    Compact set of (address, prefixlen) tuples for read-only
+    IPDB. Records are stored packed, as the address in the
+    network byte order and one byte of the prefix length,
+    and are unpacked on iteration.
+    '''
+    __slots__ = ('data', )
+
+    def __init__(self):
+        self.data = set()
+
+    @staticmethod
+    def _pack(key):
+        (addr, prefixlen) = key
+        return inet_pton(_addr_family(addr), addr) + \
+            struct.pack('B', prefixlen)
+
+    @staticmethod
+    def _unpack(value):
+        family = AF_INET if len(value) == 5 else AF_INET6
+        return (inet_ntop(family, value[:-1]),
+                struct.unpack('B', value[-1:])[0])
+
+    def add(self, key, raw=None):
+        self.data.add(self._pack(key))
+
+    def remove(self, key, raw=None):
+        self.data.remove(self._pack(key))
+
+    def __contains__(self, key):
+        try:
+            return self._pack(key) in self.data
+        except (TypeError, ValueError, IOError, OSError, struct.error):
+            return False
+
+    def __iter__(self):
+        return (self._unpack(x) for x in tuple(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class AddressIndex(object):
+    '''
+    Index of IP addresses, w/o masks, to interfaces, with
+    one dict per family and packed addresses as keys. For
+    the API it is a read-only mapping {address: set(index)}::
+
+        ip.by_ip['10.0.0.1']  # set([2])
+        ip.by_ip.get('fe80::1')
+        ip.by_ip.keys(AF_INET)
+
+    Usually an address belongs to one interface, so the
+    value is stored as the interface index, and only
+    duplicates are stored as tuples. Every (address,
+    prefixlen) record of an interface is counted.
+    '''
+    def __init__(self):
+        self.families = {AF_INET: {},
+                         AF_INET6: {}}
+
+    def _locate(self, addr):
+        family = _addr_family(addr)
+        return (self.families[family], inet_pton(family, addr))
+
+    def add(self, addr, index):
+        (table, key) = self._locate(addr)
+        value = table.get(key, None)
+        if value is None:
+            table[key] = index
+        elif isinstance(value, tuple):
+            table[key] = value + (index, )
+        else:
+            table[key] = (value, index)
+
+    def remove(self, addr, index):
+        (table, key) = self._locate(addr)
+        value = table.get(key, None)
+        if isinstance(value, tuple):
+            if index in value:
+                value = list(value)
+                value.remove(index)
+                table[key] = value[0] if len(value) == 1 else tuple(value)
+        elif value == index:
+            del table[key]
+
+    def get(self, addr, default=None):
+        try:
+            (table, key) = self._locate(addr)
+        except (TypeError, ValueError, IOError, OSError):
+            return default
+        value = table.get(key, None)
+        if value is None:
+            return default
+        if isinstance(value, tuple):
+            return set(value)
+        return set((value, ))
+
+    def __getitem__(self, addr):
+        ret = self.get(addr)
+        if ret is None:
+            raise KeyError(addr)
+        return ret
+
+    def __contains__(self, addr):
+        return self.get(addr) is not None
+
+    def keys(self, family=AF_UNSPEC):
+        return [inet_ntop(x, key) for (x, table) in self.families.items()
+                if family in (AF_UNSPEC, x) for key in table]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return sum([len(x) for x in self.families.values()])
+
+
 class State(object):
 
     def __init__(self, lock=None):
@@ -241,6 +523,8 @@ class Transactional(Dotkeys):
         self._write_lock = threading.RLock()
         self._direct_state = State(self._write_lock)
         self._linked_sets = set()
+        # keys, changed in the transaction; None -- not tracked
+        self._dirty = None
 
     def register_callback(self, callback):
         self._callbacks.append(callback)
@@ -260,12 +544,15 @@ class Transactional(Dotkeys):
         Please note, that "updated" doesn't mean "in sync".
         The reason behind this logic is that snapshots can be
         used as transactions.
+
+        Field values are not copied: they are immutable, so the
+        snapshot shares them with the object until one of them
+        sets a new value. Only linked sets are copied.
         '''
         with self._write_lock:
             res = self.__class__(nl=self.nl, mode='snapshot')
-            for key in tuple(self.keys()):
-                if key in nla_fields:
-                    res[key] = self[key]
+            dict.update(res, [(key, value) for (key, value) in self.items()
+                              if key in _nla_keys])
             for key in self._linked_sets:
                 res[key] = LinkedSet(self[key])
                 if self.ipdb is not None and not detached:
@@ -298,12 +585,17 @@ class Transactional(Dotkeys):
 
     def __sub__(self, vs):
         '''
+        Return the difference as a new snapshot. If any of the
+        objects is a transaction, only simple keys it changed
+        are compared; linked sets are compared always.
         '''
         res = self.__class__(nl=self.nl, mode='snapshot')
+        dirty = [x._dirty for x in (self, vs) if x._dirty is not None]
+        keys = set().union(*dirty) if dirty else tuple(self.keys())
         with self._direct_state:
             # simple keys
-            for key in self:
-                if (key in self._fields) and \
+            for key in keys:
+                if (key in self) and (key in self._fields) and \
                         ((key not in vs) or (self[key] != vs[key])):
                     res[key] = self[key]
         for key in self._linked_sets:
@@ -322,6 +614,7 @@ class Transactional(Dotkeys):
         # keep snapshot's ip addr set updated from the OS
         # it is required by the commit logic
         t = self.pick(detached=False)
+        t._dirty = set()
         self._transactions[t.uid] = t
         self._tids.append(t.uid)
         return t.uid
@@ -362,6 +655,8 @@ class Transactional(Dotkeys):
             transaction = self.last()
             transaction[key] = value
         else:
+            if self._dirty is not None:
+                self._dirty.add(key)
             Dotkeys.__setitem__(self, key, value)
 
     @update
@@ -371,6 +666,8 @@ class Transactional(Dotkeys):
             if key in transaction:
                 del transaction[key]
         else:
+            if self._dirty is not None:
+                self._dirty.add(key)
             Dotkeys.__delitem__(self, key)
 
     def set_item(self, key, value):
@@ -404,7 +701,45 @@ class TrafficControl(Transactional):
         pass
 
 
-class Interface(Transactional):
+class LinkStats(object):
+    '''
+    Interface methods, that do not depend on transactions.
+    '''
+    @property
+    def if_master(self):
+        '''
+        [property] Link to the parent interface -- if it exists
+        '''
+        ret = [self[i] for i in ('link', 'master')
+               if (i in self) and isinstance(self[i], int)] or [None]
+        return ret[0]
+
+    @property
+    def flap_stats(self):
+        '''
+        [property] Flap damping statistics: the number of
+        flaps (changes of the IFF_UP flag or the operstate),
+        the time of the last one and the penalty. Every flap
+        adds 1 to the penalty, that decays exponentially with
+        the half-life of 60 seconds.
+        '''
+        ret = dict(self._flaps or {'flaps': 0, 'last': None, 'penalty': 0.0})
+        if ret['last'] is not None:
+            ret['penalty'] *= 0.5 ** ((time.time() - ret['last']) /
+                                      _FLAP_HALF_LIFE)
+        return ret
+
+    def flap(self):
+        '''
+        Account one interface flap
+        '''
+        stats = self.flap_stats
+        self._flaps = {'flaps': stats['flaps'] + 1,
+                       'last': time.time(),
+                       'penalty': stats['penalty'] + 1}
+
+
+class Interface(Transactional, LinkStats):
     '''
     Objects of this class represent network interface and
     all related objects:
@@ -437,17 +772,11 @@ class Interface(Transactional):
             * mode -- transaction mode
         '''
         Transactional.__init__(self, nl, ipdb, mode)
-        self.cleanup = ('header',
-                        'linkinfo',
-                        'af_spec',
-                        'attrs',
-                        'event',
-                        'map',
-                        'stats',
-                        'stats64')
+        self.cleanup = _LINK_CLEANUP
         self.ingress = None
         self.egress = None
         self._exists = False
+        self._flaps = None
         self._fields = nla_fields
         self._load_event = threading.Event()
         self._linked_sets.add('ipaddr')
@@ -457,24 +786,13 @@ class Interface(Transactional):
         with self._direct_state:
             self['ipaddr'] = LinkedSet()
             self['ports'] = LinkedSet()
-            for i in nla_fields:
-                self[i] = None
-            for i in ('state', 'change', 'mask'):
-                del self[i]
+            dict.update(self, [(i, None) for i in nla_fields
+                               if i not in ('state', 'change', 'mask')])
         # 8<-----------------------------------
 
     def __hash__(self):
         return self['index']
 
-    @property
-    def if_master(self):
-        '''
-        [property] Link to the parent interface -- if it exists
-        '''
-        ret = [self[i] for i in ('link', 'master')
-               if (i in self) and isinstance(self[i], int)] or [None]
-        return ret[0]
-
     def load(self, dev):
         '''
         Update the interface info from RTM_NEWLINK message.
@@ -491,14 +809,8 @@ class Interface(Transactional):
                 self._attrs.add(norm)
                 self[norm] = value
             # load interface kind
-            linkinfo = dev.get_attr('IFLA_LINKINFO')
-            if linkinfo is not None:
-                kind = linkinfo.get_attr('IFLA_INFO_KIND')
-                if kind is not None:
-                    self['kind'] = kind
-                    if kind == 'vlan':
-                        data = linkinfo.get_attr('IFLA_INFO_DATA')
-                        self['vlan_id'] = data.get_attr('IFLA_VLAN_ID')
+            for (key, value) in get_link_kind(dev).items():
+                self[key] = value
             # the rest is possible only when interface
             # is used in IPDB, not standalone
             if self.ipdb is not None:
@@ -570,13 +882,38 @@ class Interface(Transactional):
     def reload(self):
         '''
         Reload interface information
+
+        In IPDB the call returns when the monitor applies the
+        response to this very request, so concurrent changes
+        of other interfaces can not confirm it.
         '''
-        self._load_event.clear()
+        if self.ipdb is None:
+            self._load_event.clear()
+            try:
+                self.nl.get_links(self['index'])
+            except Empty:
+                raise IOError('lost netlink connection')
+            self._load_event.wait()
+            return
+        msg = ifinfmsg()
+        msg['family'] = AF_UNSPEC
+        msg['index'] = self['index']
+        (nonce, event) = self.ipdb._expect()
         try:
-            self.nl.get_links(self['index'])
+            self.nl.nlm_request(msg, RTM_GETLINK, NLM_F_REQUEST,
+                                nonce=nonce)
+            event.wait(_SYNC_TIMEOUT)
         except Empty:
             raise IOError('lost netlink connection')
-        self._load_event.wait()
+        finally:
+            self.ipdb._forget(nonce)
+        if not event.is_set():
+            # the mirrored response is lost, e.g. on the event
+            # queue overrun, so load the interface directly
+            links = self.nl.nlm_request(msg, RTM_GETLINK, NLM_F_REQUEST,
+                                        mirror=False)
+            with self.ipdb.lock:
+                self.ipdb._apply(links)
 
     def commit(self, tid=None, transaction=None, rollback=False):
         '''
@@ -594,7 +931,7 @@ class Interface(Transactional):
         # if the interface does not exist, create it first ;)
         if not self._exists:
             request = IPLinkRequest(self)
-            self.ipdb._links_event.clear()
+            self._load_event.clear()
             try:
                 self.nl.link('add', **request)
             except Exception as e:
@@ -615,9 +952,13 @@ class Interface(Transactional):
                 raise e
 
             # all is OK till now, so continue
-            # we do not know what to load, so load everything
-            self.nl.get_links()
-            self.ipdb._links_event.wait()
+            # wait for the interface to be loaded by IPDB, and
+            # request it by name, if the broadcast is lost
+            self._load_event.wait(_SYNC_TIMEOUT)
+            if not self._load_event.is_set():
+                self.nl.link_lookup(ifname=self['ifname'])
+                self._load_event.wait(_SYNC_TIMEOUT)
+            assert self._load_event.is_set()
 
         # now we have our index and IP set and all other stuff
         snapshot = self.pick()
@@ -754,8 +1095,7 @@ class Interface(Transactional):
                 # getting RuntimeError() from commit(), take a seat
                 # and rest for a while. It is an extremal case, it
                 # should not became at all, and there is no sync.
-                self.nl.get_links()
-                self.nl.get_addr()
+                self.ipdb.refresh([self['index']])
                 x = RuntimeError()
                 x.cause = e
                 raise x
@@ -792,6 +1132,635 @@ class Interface(Transactional):
         self['removal'] = True
 
 
+class ReadonlyInterface(Dotkeys, LinkStats):
+    '''
+    Compact interface record for IPDB(mode='readonly'). It
+    keeps only fields reported by the kernel, missing fields
+    read as None. There are no transactions and no locks:
+    the record is updated only by the IPDB monitor, and all
+    the write attempts raise TypeError.
+    '''
+    _mode = 'readonly'
+    cleanup = _LINK_CLEANUP
+    # attributes, that are set by IPDB itself
+    _attrs = ('ipdb', '_flaps')
+
+    def __init__(self, nl=None, ipdb=None, mode='readonly'):
+        self.ipdb = ipdb
+        self._flaps = None
+        dict.__setitem__(self, 'ipaddr', PlainSet())
+        dict.__setitem__(self, 'ports', PlainSet())
+
+    def __hash__(self):
+        return self['index']
+
+    def __missing__(self, key):
+        if key in _nla_keys:
+            return None
+        raise KeyError(key)
+
+    def _deny(self, *argv, **kwarg):
+        raise TypeError('read-only mode')
+
+    def __setattr__(self, key, value):
+        # Dotkeys would set unknown fields as plain attributes
+        if key not in self._attrs:
+            self._deny()
+        dict.__setattr__(self, key, value)
+
+    __setitem__ = __delitem__ = __delattr__ = _deny
+    begin = commit = review = drop = pick = _deny
+    add_ip = del_ip = up = down = remove = _deny
+
+    def load(self, dev):
+        '''
+        Update the record from RTM_NEWLINK message.
+        '''
+        dict.update(self, dev)
+        for (name, value) in dev['attrs']:
+            dict.__setitem__(self, ifinfmsg.nla2name(name), value)
+        dict.update(self, get_link_kind(dev))
+        if self.ipdb is not None:
+            dict.__setitem__(self, 'ipaddr',
+                             self.ipdb.ipaddr[self['index']])
+        for item in self.cleanup:
+            if item in self:
+                dict.__delitem__(self, item)
+
+    def sync(self):
+        pass
+
+    def set_item(self, key, value):
+        dict.__setitem__(self, key, value)
+
+    def del_item(self, key):
+        dict.__delitem__(self, key)
+
+    def add_port(self, port, direct=False):
+        if not direct:
+            self._deny()
+        self['ports'].add(port)
+
+    def del_port(self, port, direct=False):
+        if not direct:
+            self._deny()
+        self['ports'].remove(port)
+
+
+class RouteTrie(object):
+    '''
+    Binary trie of routes of one family in one table. Every
+    node is a list [zero, one, routes], where `routes` is
+    None or a dict {(priority, tos): msg}. Lookups walk not
+    more than `bits` nodes.
+    '''
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]
+        self.size = 0
+
+    def add(self, addr, plen, key, msg):
+        node = self.root
+        for shift in range(self.bits - 1, self.bits - 1 - plen, -1):
+            bit = (addr >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            node[2] = {}
+        if key not in node[2]:
+            self.size += 1
+        old = node[2].get(key, None)
+        node[2][key] = msg
+        return old
+
+    def remove(self, addr, plen, key):
+        path = []
+        node = self.root
+        for shift in range(self.bits - 1, self.bits - 1 - plen, -1):
+            bit = (addr >> shift) & 1
+            path.append((node, bit))
+            node = node[bit]
+            if node is None:
+                return None
+        if not node[2] or key not in node[2]:
+            return None
+        msg = node[2].pop(key)
+        self.size -= 1
+        if not node[2]:
+            node[2] = None
+        # prune empty branches
+        while path and node == [None, None, None]:
+            (node, bit) = path.pop()
+            node[bit] = None
+        return msg
+
+    def match(self, addr):
+        '''
+        Return route dicts of all the prefixes that cover
+        the address, from the longest to the shortest one.
+        '''
+        ret = []
+        node = self.root
+        shift = self.bits - 1
+        while node is not None:
+            if node[2] is not None:
+                ret.append(node[2])
+            if shift < 0:
+                break
+            node = node[(addr >> shift) & 1]
+            shift -= 1
+        ret.reverse()
+        return ret
+
+    def __iter__(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node[2] is not None:
+                for msg in tuple(node[2].values()):
+                    yield msg
+            stack.extend([x for x in node[:2] if x is not None])
+
+    def __len__(self):
+        return self.size
+
+
+class RoutingTables(object):
+    '''
+    Live mirror of routing tables, IPv4 and IPv6, as a set
+    of tries {(family, table): RouteTrie}. It is updated
+    by RTM_NEWROUTE and RTM_DELROUTE events::
+
+        ip.routes.lookup('10.0.0.1')  # main table
+        ip.routes.lookup('fe80::1', table=255)
+        ip.routes.match('10.0.0.1')  # all covering routes
+
+    Lookups use only one table and do not evaluate rules.
+    Routes, returned by lookups, are raw rtmsg objects and
+    should not be modified.
+    '''
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tables = {}
+        self.by_oif = {}  # {oif: set(location), ...}
+
+    @staticmethod
+    def _addr(family, addr):
+        return int(binascii.hexlify(inet_pton(family, addr)), 16)
+
+    @staticmethod
+    def _table(msg):
+        return msg.get_attr('RTA_TABLE') or msg['table']
+
+    def _locate(self, msg):
+        family = msg['family']
+        if family not in _ADDR_BITS:
+            return None
+        dst = msg.get_attr('RTA_DST')
+        addr = self._addr(family, dst) if dst else 0
+        key = (msg.get_attr('RTA_PRIORITY') or 0, msg['tos'])
+        if family == AF_INET6:
+            # IPv6 keeps routes to one prefix with one metric
+            # via different nexthops as separate routes
+            key += (msg.get_attr('RTA_OIF') or 0,
+                    msg.get_attr('RTA_GATEWAY') or '')
+        return ((family, self._table(msg)), addr, msg['dst_len'], key)
+
+    def _unlink(self, location, msg):
+        if msg is None:
+            return
+        oif = msg.get_attr('RTA_OIF')
+        locations = self.by_oif.get(oif, set())
+        locations.discard(location)
+        if not locations:
+            self.by_oif.pop(oif, None)
+
+    def add(self, msg):
+        if msg['flags'] & _RTM_F_CLONED:
+            return
+        location = self._locate(msg)
+        if location is None:
+            return
+        (table, addr, plen, key) = location
+        with self.lock:
+            if table not in self.tables:
+                self.tables[table] = RouteTrie(_ADDR_BITS[table[0]])
+            self._unlink(location,
+                         self.tables[table].add(addr, plen, key, msg))
+            self.by_oif.setdefault(msg.get_attr('RTA_OIF'),
+                                   set()).add(location)
+
+    def remove(self, msg):
+        location = self._locate(msg)
+        if location is None:
+            return
+        (table, addr, plen, key) = location
+        with self.lock:
+            if table in self.tables:
+                self._unlink(location,
+                             self.tables[table].remove(addr, plen, key))
+
+    def load(self, routes, family=None):
+        '''
+        Replace tables of the family (all by default)
+        with routes from a dump.
+        '''
+        with self.lock:
+            for table in tuple(self.tables):
+                if family in (None, table[0]):
+                    del self.tables[table]
+            for oif in tuple(self.by_oif):
+                self.by_oif[oif] = set([x for x in self.by_oif[oif]
+                                        if x[0] in self.tables])
+                if not self.by_oif[oif]:
+                    del self.by_oif[oif]
+            for msg in routes:
+                self.add(msg)
+
+    def flush(self, index):
+        '''
+        Drop routes via the interface. The kernel does not
+        send RTM_DELROUTE for routes, that are removed with
+        the interface or when it goes down.
+        '''
+        with self.lock:
+            for location in tuple(self.by_oif.pop(index, ())):
+                (table, addr, plen, key) = location
+                if table in self.tables:
+                    self.tables[table].remove(addr, plen, key)
+
+    def match(self, dst, table=_RT_TABLE_MAIN):
+        '''
+        Return all routes that cover the destination,
+        from the longest prefix to the shortest one.
+        '''
+        family = AF_INET6 if dst.find(':') > -1 else AF_INET
+        addr = self._addr(family, dst)
+        with self.lock:
+            trie = self.tables.get((family, table), None)
+            if trie is None:
+                return []
+            return [msg for routes in trie.match(addr)
+                    for (key, msg) in sorted(routes.items())]
+
+    def lookup(self, dst, table=_RT_TABLE_MAIN):
+        '''
+        Return the route, that carries the destination:
+        the longest prefix, with the lowest metric, or
+        None, if there is no route.
+        '''
+        ret = self.match(dst, table)
+        return ret[0] if ret else None
+
+    def __iter__(self):
+        with self.lock:
+            ret = [msg for trie in self.tables.values() for msg in trie]
+        return iter(ret)
+
+    def __len__(self):
+        with self.lock:
+            return sum([len(x) for x in self.tables.values()])
+
+
+Neighbor = collections.namedtuple('Neighbor', ('ifindex',
+                                               'dst',
+                                               'lladdr',
+                                               'state',
+                                               'flags',
+                                               'family'))
+
+
+class NeighborTable(object):
+    '''
+    Live mirror of ARP and NDP tables. Entries are stored as
+    `Neighbor` tuples, not as ndmsg objects, and are indexed
+    by (ifindex, dst) and by lladdr::
+
+        ip.neighbors.get(2, '10.0.0.1')
+        ip.neighbors.by_lladdr('52:54:00:12:34:56')
+        ip.neighbors.by_ifindex(2)
+
+    Iteration returns a snapshot of all the entries.
+    '''
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.entries = {}   # {(ifindex, dst): Neighbor, ...}
+        self.lladdr = {}    # {lladdr: set((ifindex, dst)), ...}
+
+    def _unlink(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry.lladdr is not None:
+            keys = self.lladdr[entry.lladdr]
+            keys.discard(key)
+            if not keys:
+                del self.lladdr[entry.lladdr]
+        return entry
+
+    def add(self, msg):
+        if msg['family'] not in _ADDR_BITS:
+            return
+        entry = Neighbor(msg['ifindex'],
+                         msg.get_attr('NDA_DST'),
+                         msg.get_attr('NDA_LLADDR'),
+                         msg['state'],
+                         msg['flags'],
+                         msg['family'])
+        key = (entry.ifindex, entry.dst)
+        with self.lock:
+            self._unlink(key)
+            self.entries[key] = entry
+            if entry.lladdr is not None:
+                self.lladdr.setdefault(entry.lladdr, set()).add(key)
+
+    def remove(self, msg):
+        with self.lock:
+            self._unlink((msg['ifindex'], msg.get_attr('NDA_DST')))
+
+    def load(self, neighbors):
+        '''
+        Replace all the entries with neighbors from a dump.
+        '''
+        with self.lock:
+            self.entries = {}
+            self.lladdr = {}
+            for msg in neighbors:
+                self.add(msg)
+
+    def flush(self, index, permanent=True):
+        '''
+        Drop entries of the interface. The kernel flushes
+        the entries on the interface removal, and all but
+        permanent ones when the interface goes down.
+        '''
+        with self.lock:
+            for entry in self.by_ifindex(index):
+                if permanent or \
+                        not entry.state & (_NUD_PERMANENT | _NUD_NOARP):
+                    self._unlink((entry.ifindex, entry.dst))
+
+    def get(self, ifindex, dst, default=None):
+        return self.entries.get((ifindex, dst), default)
+
+    def by_lladdr(self, lladdr):
+        with self.lock:
+            return [self.entries[x] for x in self.lladdr.get(lladdr, ())]
+
+    def by_ifindex(self, ifindex):
+        with self.lock:
+            return [x for x in self.entries.values()
+                    if x.ifindex == ifindex]
+
+    def __iter__(self):
+        with self.lock:
+            return iter(tuple(self.entries.values()))
+
+    def __len__(self):
+        return len(self.entries)
+
+
+Change = collections.namedtuple('Change', ('version',
+                                           'kind',
+                                           'key',
+                                           'diff'))
+
+
+class Journal(object):
+    '''
+    Bounded ring of changes, applied to the database, with
+    monotonically increasing versions. Every record is a
+    `Change` tuple:
+
+        * link -- key is the interface index, diff is as for
+          callbacks, see IPDB.register_callback()
+        * addr -- key is the interface index, diff is
+          {'ipaddr': (address, prefixlen)}
+        * route -- key is (family, table, dst, dst_len,
+          priority, tos), for IPv6 also oif and gateway, as
+          routes in RoutingTables; diff is {'gateway': ...,
+          'oif': ..., 'priority': ...}
+        * neighbor -- key is (ifindex, dst), diff is
+          {'lladdr': ..., 'state': ...}
+
+    Removals have 'removal': True in the diff. Routes and
+    neighbors, that are dropped with an interface, are not
+    recorded, as the kernel does not report them. When a
+    table is reloaded from the OS, the record is
+    (kind, None, {'reload': True}).
+    '''
+    def __init__(self, size):
+        self.lock = threading.Condition()
+        self.entries = collections.deque(maxlen=size)
+        self.size = size
+        self.version = 0
+
+    def record(self, kind, key, diff):
+        with self.lock:
+            self.version += 1
+            self.entries.append(Change(self.version, kind, key, diff))
+            self.lock.notify_all()
+
+    def since(self, version, timeout=None):
+        '''
+        Return changes after the version, or None if they
+        are dropped from the ring already. With `timeout`,
+        wait for changes, if there are no ones yet.
+        '''
+        with self.lock:
+            if timeout is not None:
+                deadline = time.time() + timeout
+                while version >= self.version:
+                    delay = deadline - time.time()
+                    if delay <= 0:
+                        break
+                    self.lock.wait(delay)
+            if version >= self.version:
+                return []
+            first = self.version - len(self.entries) + 1
+            if version + 1 < first:
+                return None
+            return list(itertools.islice(self.entries,
+                                         version + 1 - first,
+                                         None))
+
+
+class SeqlockFile(object):
+    '''
+    Publisher side of a shared memory snapshot: a file,
+    mapped with mmap, that contains the header (sequence,
+    length) and the data. The sequence is odd while the
+    data is being written, so readers (IPDBView) retry
+    reads, that overlap with a write. The file grows if
+    the data does not fit, readers remap it.
+
+    Only one publisher per file is supported.
+    '''
+    def __init__(self, path, size=_SHM_SIZE):
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = max(size, os.fstat(self.fd).st_size)
+        os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        (seq, length) = _SHM_HEADER.unpack_from(self.map, 0)
+        # continue the sequence of a previous publisher
+        self.seq = seq + (seq & 1)
+
+    def write(self, data):
+        with self.lock:
+            if self.map is None:
+                return None
+            need = _SHM_HEADER.size + len(data)
+            if need > len(self.map):
+                size = len(self.map)
+                while size < need:
+                    size *= 2
+                os.ftruncate(self.fd, size)
+                self.map.close()
+                self.map = mmap.mmap(self.fd, size)
+            _SHM_HEADER.pack_into(self.map, 0, self.seq + 1, 0)
+            self.map[_SHM_HEADER.size:need] = data
+            self.seq += 2
+            _SHM_HEADER.pack_into(self.map, 0, self.seq, len(data))
+            return self.seq // 2
+
+    def close(self):
+        with self.lock:
+            self.map.close()
+            self.map = None
+            os.close(self.fd)
+
+
+class IPDBView(object):
+    '''
+    Read-only view of IPDB, published by another process
+    with IPDB.publish()::
+
+        # the owner process
+        ip = IPDB(mode='readonly')
+        ip.publish('/dev/shm/ipdb')
+
+        # workers
+        view = IPDBView('/dev/shm/ipdb')
+        view.eth0.mtu
+        view.by_index[2].ipaddr
+        view.routes  # list of dicts
+
+    Workers do not use netlink at all. Every access checks
+    the snapshot version and reloads the snapshot only if
+    it is changed. Interfaces are plain Dotkeys, `ipaddr`
+    is a list of (address, prefixlen) tuples.
+    '''
+    def __init__(self, path, timeout=1):
+        self._timeout = timeout
+        self._fd = os.open(path, os.O_RDONLY)
+        self._map = mmap.mmap(self._fd, os.fstat(self._fd).st_size,
+                              access=mmap.ACCESS_READ)
+        self._seq = None
+        self._version = None
+        self._by_name = Dotkeys()
+        self._by_index = Dotkeys()
+        self._routes = []
+        self.refresh()
+
+    def _read(self):
+        deadline = time.time() + self._timeout
+        while time.time() < deadline:
+            (seq, length) = _SHM_HEADER.unpack_from(self._map, 0)
+            if seq == self._seq:
+                return None
+            if seq & 1:
+                time.sleep(0)
+                continue
+            need = _SHM_HEADER.size + length
+            if need > len(self._map):
+                # the publisher has grown the file
+                self._map.close()
+                self._map = mmap.mmap(self._fd,
+                                      os.fstat(self._fd).st_size,
+                                      access=mmap.ACCESS_READ)
+                continue
+            data = self._map[_SHM_HEADER.size:need]
+            if _SHM_HEADER.unpack_from(self._map, 0)[0] == seq:
+                return (seq, data)
+        raise IOError('shared snapshot is not consistent')
+
+    def refresh(self):
+        '''
+        Reload the snapshot, if it is changed. Return the
+        snapshot version.
+        '''
+        ret = self._read()
+        if ret is None:
+            return self._version
+        (seq, data) = ret
+        self._seq = seq
+        if not data:
+            # nothing is published yet
+            return self._version
+        state = json.loads(data.decode('utf-8'))
+        by_name = Dotkeys()
+        by_index = Dotkeys()
+        for link in state['links']:
+            interface = Dotkeys(link)
+            interface['ipaddr'] = [tuple(x) for x in link['ipaddr']]
+            by_name[interface['ifname']] = interface
+            by_index[interface['index']] = interface
+        self._by_name = by_name
+        self._by_index = by_index
+        self._routes = state['routes']
+        self._version = seq // 2
+        return self._version
+
+    @property
+    def version(self):
+        return self.refresh()
+
+    @property
+    def by_name(self):
+        self.refresh()
+        return self._by_name
+
+    @property
+    def by_index(self):
+        self.refresh()
+        return self._by_index
+
+    @property
+    def routes(self):
+        self.refresh()
+        return self._routes
+
+    def __getitem__(self, key):
+        return self.by_name[key]
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __contains__(self, key):
+        return key in self.by_name
+
+    def __iter__(self):
+        return iter(tuple(self.by_name))
+
+    def keys(self):
+        return list(self.by_name.keys())
+
+    def release(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
 class IPDB(Dotkeys):
     '''
     The class that maintains information about network setup
@@ -799,43 +1768,105 @@ class IPDB(Dotkeys):
     immediately. It uses no polling.
 
     No methods of the class should be called directly.
+
+    Beside of `by_name` and `by_index`, interfaces are indexed
+    by some fields, every index is a dict {value: set(index)}:
+
+    * by_kind -- interface kind, 'bridge', 'vlan' etc.
+    * by_address -- MAC address
+    * by_operstate -- operstate, 'UP', 'DOWN' etc.
+    * by_ip -- IP address, w/o mask, see AddressIndex
+
+    `masters` maps port indices to indices of their masters.
+
+    The database and all the indexes are changed only with
+    `IPDB.lock` acquired, so acquire it to iterate them or
+    to get a consistent view of several ones. Interfaces can
+    be committed from different threads concurrently: every
+    commit waits only for events of its own interface.
+
+    With mode='readonly' interfaces are ReadonlyInterface
+    records: no transactions, no per-interface locks, and
+    every attempt to change the database raises TypeError.
     '''
+    # interface field -> index attribute
+    indexes = {'kind': 'by_kind',
+               'address': 'by_address',
+               'operstate': 'by_operstate'}
 
     def __init__(self, nl=None, host=None, mode='implicit',
-                 key=None, cert=None, ca=None, iclass=Interface):
+                 key=None, cert=None, ca=None, iclass=Interface,
+                 restore=None, journal=0, keep_raw=False):
         '''
         Parameters:
             * nl -- IPRoute() reference
+            * restore -- snapshot file, saved by IPDB.save()
+            * journal -- size of the change journal, see
+              changes_since(); it is disabled by default, as
+              it costs a copy of every changed interface
+            * keep_raw -- keep ifaddrmsg of every address in
+              `LinkedSet.raw` of interface `ipaddr`
 
         If you do not provide iproute instance, ipdb will
         start it automatically. Please note, that there can
         be only one iproute instance per process. Actually,
         you can start two and more iproute instances, but
         only the first one will receive anything.
+
+        With `restore`, the database is loaded from the
+        snapshot and then synchronized with the OS, so only
+        changed interfaces and addresses are reloaded. For
+        the local system links are checked against
+        /sys/class/net, w/o a full link dump; otherwise
+        resync() is used. If the snapshot can not be read,
+        IPDB starts from scratch.
         '''
         self.nl = nl or IPRoute(host=host, key=key, cert=cert, ca=ca)
         self.mode = mode
+        # the monitor applies every batch of events with the lock
+        self.lock = threading.RLock()
+        self._callbacks = []  # [(callback, coalescer), ...]
+        self._publisher = None  # (SeqlockFile, Coalescer)
+        self._stale_routes = False
+        self.journal = Journal(journal)
         self._stop = False
+        if mode == 'readonly' and iclass is Interface:
+            iclass = ReadonlyInterface
         self.iclass = iclass
+        self._sclass = AddressSet if mode == 'readonly' else LinkedSet
+        self.keep_raw = keep_raw
 
         # resolvers
         self.by_name = Dotkeys()
         self.by_index = Dotkeys()
+        self.by_kind = {}
+        self.by_address = {}
+        self.by_operstate = {}
+        self.by_ip = AddressIndex()
+        self.masters = {}
+        self._indexed = {}  # {index: {field: value}, ...}
 
         # caches
         self.ipaddr = {}
-        self.routes = {}
-        self.neighbors = {}
+        self.routes = RoutingTables()
+        self.neighbors = NeighborTable()
         self.old_names = {}
 
         # update events
         self._links_event = threading.Event()
+        self._confirmations = {}  # {nonce: event, ...}
+        self._confirm_lock = threading.Lock()
+        self._waiters = []  # [(keys, event), ...]
+        self._waiters_lock = threading.Lock()
 
         # load information on startup
-        links = self.nl.get_links()
-        self.update_links(links)
-        self.update_slaves(links)
-        self.update_addr(self.nl.get_addr())
+        if restore is None or not self._restore(restore):
+            links = self._dump_links()
+            self.update_links(links)
+            self.update_slaves(links)
+            self.update_addr(self._dump_addr())
+            self.reload_routes()
+            self.reload_neighbors()
 
         # start monitoring thread
         self.nl.mirror()
@@ -853,8 +1884,102 @@ class IPDB(Dotkeys):
         ret = Dotkeys.__dir__(self)
         ret.append('by_name')
         ret.append('by_index')
+        ret.extend(self.indexes.values())
+        ret.append('by_ip')
         return ret
 
+    def register_callback(self, callback, window=None):
+        '''
+        Register a callback to run on interface changes::
+
+            def cb(interface, diff):
+                print(interface['ifname'], diff)
+
+            ip.register_callback(cb)
+
+        The diff is a dict of changed fields with new values,
+        {'removal': True} for removed interfaces. With `window`
+        (seconds) the callback is called not more often than
+        once per window for every interface, with the merged
+        diff.
+        '''
+        coalescer = None
+        if window is not None:
+            def merge(old, new):
+                diff = dict(old[1])
+                diff.update(new[1])
+                return (new[0], diff)
+            coalescer = Coalescer(lambda key, data: callback(*data),
+                                  window,
+                                  merge)
+        self._callbacks.append((callback, coalescer))
+
+    def unregister_callback(self, callback):
+        for record in tuple(self._callbacks):
+            if record[0] == callback:
+                self._callbacks.remove(record)
+                if record[1] is not None:
+                    record[1].flush()
+                return
+
+    def _notify(self, interface, diff):
+        for (callback, coalescer) in tuple(self._callbacks):
+            try:
+                if coalescer is not None:
+                    coalescer.push(interface['index'], (interface, diff))
+                else:
+                    callback(interface, diff)
+            except Exception:
+                pass
+
+    @staticmethod
+    def _diff(old, new):
+        return dict([(key, value) for (key, value) in new.items()
+                     if key not in ('ipaddr', 'ports') and
+                     old.get(key, None) != value])
+
+    @staticmethod
+    def _index_add(index, value, key):
+        index.setdefault(value, set()).add(key)
+
+    @staticmethod
+    def _index_remove(index, value, key):
+        keys = index.get(value, set())
+        keys.discard(key)
+        if not keys:
+            index.pop(value, None)
+
+    def _reindex(self, interface):
+        '''
+        Update secondary indexes for the interface
+        '''
+        key = interface['index']
+        old = self._indexed.get(key, {})
+        new = {}
+        for (field, name) in self.indexes.items():
+            value = interface.get(field, None)
+            if old.get(field, None) == value:
+                new[field] = value
+                continue
+            if old.get(field, None) is not None:
+                self._index_remove(getattr(self, name), old[field], key)
+            if value is not None:
+                self._index_add(getattr(self, name), value, key)
+            new[field] = value
+        self._indexed[key] = new
+
+    def _unindex(self, key):
+        '''
+        Drop the interface from secondary indexes
+        '''
+        old = self._indexed.pop(key, {})
+        for (field, name) in self.indexes.items():
+            if old.get(field, None) is not None:
+                self._index_remove(getattr(self, name), old[field], key)
+        for (ip, mask) in self.ipaddr.get(key, ()):
+            self.by_ip.remove(ip, key)
+        self.masters.pop(key, None)
+
     def release(self):
         '''
         Shutdown monitoring thread and release iproute.
@@ -863,6 +1988,76 @@ class IPDB(Dotkeys):
         self.nl.get_links()
         self.nl.release()
         self._mthread.join()
+        if self._publisher is not None:
+            (shm, coalescer) = self._publisher
+            self._publisher = None
+            coalescer.flush()
+            shm.close()
+
+    def publish(self, path, window=1):
+        '''
+        Publish the database into the shared memory file
+        `path` (e.g. /dev/shm/ipdb) for IPDBView readers in
+        other processes: interfaces with addresses and
+        ports, and routes. The snapshot is written on
+        changes, not more often than once per `window`
+        seconds, and is versioned. With many interfaces
+        an export takes a noticeable time, so keep the
+        window not shorter than that.
+
+        The file is not removed on release(), so readers
+        keep the last snapshot.
+        '''
+        if self._publisher is not None:
+            raise RuntimeError('the database is published already')
+        shm = SeqlockFile(path)
+
+        def write(key, data):
+            # only copy references under the lock, the export
+            # itself should not block the event processing
+            with self.lock:
+                snapshot = self._snapshot()
+            state = self._export(snapshot)
+            shm.write(json.dumps(state).encode('utf-8'))
+
+        write(None, None)
+        self._publisher = (shm, Coalescer(write, window))
+
+    def _snapshot(self):
+        '''
+        Copy the state to export, should be called with
+        the database lock held
+        '''
+        links = [(dict.copy(interface),
+                  tuple(self.ipaddr.get(index, ())),
+                  tuple(dict.get(interface, 'ports') or ()))
+                 for (index, interface) in tuple(self.by_index.items())]
+        return (links, list(self.routes))
+
+    @staticmethod
+    def _export(snapshot):
+        '''
+        Export the snapshot as JSON serializable dict
+        '''
+        (interfaces, msgs) = snapshot
+        links = []
+        for (interface, ipaddr, ports) in interfaces:
+            link = dict([(key, value) for (key, value)
+                         in interface.items()
+                         if isinstance(value, _SHM_TYPES)])
+            link['ipaddr'] = sorted(ipaddr)
+            link['ports'] = sorted(ports)
+            links.append(link)
+        routes = []
+        for msg in msgs:
+            route = dict([(key, value) for (key, value) in msg.items()
+                          if isinstance(value, _SHM_TYPES)])
+            for (name, value) in msg['attrs']:
+                if isinstance(value, _SHM_TYPES):
+                    route[msg.nla2name(name)] = value
+            routes.append(route)
+        return {'links': links,
+                'routes': routes}
 
     def create(self, kind, ifname, **kwarg):
         '''
@@ -882,19 +2077,315 @@ class IPDB(Dotkeys):
 
         FIXME: this should be documented.
         '''
+        if self.mode == 'readonly':
+            raise TypeError('read-only mode')
         i = self.iclass(nl=self.nl, ipdb=self, mode='snapshot')
         i['kind'] = kind
         i['index'] = kwarg.get('index', 0)
         i['ifname'] = ifname
-        self.by_name[i['ifname']] = self[i['ifname']] = i
+        with self.lock:
+            self.by_name[i['ifname']] = self[i['ifname']] = i
         i.update(kwarg)
         i._mode = self.mode
         i.begin()
         return i
 
     def detach(self, item):
-        if item in self:
-            del self[item]
+        with self.lock:
+            if item in self:
+                if self.by_name.get(item, None) is self[item]:
+                    del self.by_name[item]
+                del self[item]
+
+    def _expect(self):
+        '''
+        Allocate a nonce for a request and an event, that is
+        set when the monitor applies the mirrored response.
+        The event must be released with _forget().
+        '''
+        nonce = self.nl.nonce()
+        event = threading.Event()
+        with self._confirm_lock:
+            self._confirmations[nonce] = event
+        return (nonce, event)
+
+    def _forget(self, nonce):
+        with self._confirm_lock:
+            self._confirmations.pop(nonce, None)
+
+    def _confirm(self, messages):
+        '''
+        Set events of requests, which responses are applied.
+        '''
+        if not self._confirmations:
+            return
+        with self._confirm_lock:
+            for msg in messages:
+                nonce = msg['header'].get('sequence_number', 0)
+                if nonce in self._confirmations:
+                    self._confirmations.pop(nonce).set()
+
+    def commit(self, *interfaces):
+        '''
+        Commit open transactions of several interfaces as one
+        transaction::
+
+            for x in range(100, 200):
+                ip.create(kind='vlan', ifname='v%i' % x,
+                          link=ip.eth0.index, vlan_id=x)
+                ip['v%i' % x].add_ip('10.%i.0.1/24' % x)
+            ip.commit()
+
+        Interfaces can be given as objects, names or indices;
+        by default all the interfaces with open transactions
+        are committed. Netlink requests of all the interfaces
+        are pipelined, and confirmations are awaited together.
+
+        If anything goes wrong, all the interfaces are rolled
+        back, and interfaces created by the transaction are
+        removed.
+        '''
+        if self.mode == 'readonly':
+            raise TypeError('read-only mode')
+        interfaces = [x if isinstance(x, Transactional) else self[x]
+                      for x in interfaces]
+        if not interfaces:
+            for x in tuple(self.by_name.values()):
+                if x._tids and x not in interfaces:
+                    interfaces.append(x)
+        plan = [(x, x.last()) for x in interfaces]
+        created = []
+        snapshots = []
+        try:
+            created = self._bulk_create([x for (x, t) in plan
+                                         if not x._exists])
+            snapshots = [(x, x.pick()) for (x, t) in plan]
+            self._bulk_apply(plan, snapshots)
+        except Exception as e:
+            error = e
+            try:
+                self._bulk_rollback(plan, snapshots, created)
+            except Exception as x:
+                for (interface, t) in plan:
+                    interface.drop()
+                    interface['ipaddr'].set_target(None)
+                    interface['ports'].set_target(None)
+                self.refresh([x['index'] for (x, t) in plan
+                              if x._mode != 'invalid'])
+                error = RuntimeError()
+                error.cause = x
+                raise error
+            error.transaction = [t for (x, t) in plan]
+            raise error
+
+        for (interface, transaction) in plan:
+            interface.drop()
+            if transaction.get('removal', None):
+                interface._mode = 'invalid'
+        self._bulk_reload([x for (x, t) in plan
+                           if not t.get('removal', None)])
+
+    def refresh(self, indices):
+        '''
+        Request links and addresses of interfaces from the OS.
+        The results are applied asynchronously by the monitor,
+        as any other events.
+        '''
+        indices = [x for x in indices if x]
+        if not indices:
+            return
+        try:
+            self.nl.get_links(*indices)
+        except NetlinkError:
+            # some interfaces are already removed
+            pass
+        if len(indices) > self.nl.dump_threshold:
+            self.nl.get_addr()
+        else:
+            for index in indices:
+                self.nl.get_addr(index=index)
+
+    def _bulk_wait(self, events, timeout):
+        # wait for events with one common timeout
+        deadline = time.time() + timeout
+        for event in events:
+            event.wait(max(deadline - time.time(), 0))
+            assert event.is_set()
+
+    def _bulk_timeout(self, requests):
+        # the monitor needs time to apply all the events
+        return _SYNC_TIMEOUT + len(requests) * 0.01
+
+    def _bulk_create(self, interfaces):
+        '''
+        Create interfaces, return the list of created ones. On
+        failure, incl. the load timeout, created interfaces are
+        removed, and all the interfaces are invalidated and
+        detached.
+        '''
+        if not interfaces:
+            return []
+        requests = [self.nl._link_msg('add', **IPLinkRequest(x))
+                    for x in interfaces]
+        error = None
+        created = []
+        for (interface, ret) in zip(interfaces,
+                                    self.nl.nlm_request_batch(
+                                        requests, window=_BULK_WINDOW)):
+            if isinstance(ret, Exception):
+                error = error or ret
+            else:
+                created.append(interface)
+        if error is None:
+            try:
+                self._bulk_wait([x._load_event for x in interfaces],
+                                self._bulk_timeout(requests))
+                return created
+            except Exception as e:
+                # the interfaces exist in the OS, but are not loaded
+                error = e
+        # remove interfaces created so far
+        for interface in created:
+            try:
+                # the index can be unknown yet, so delete by name
+                self.nl.link('delete', index=0,
+                             ifname=interface['ifname'])
+            except NetlinkError:
+                pass
+        for interface in interfaces:
+            interface.nl = None
+            self.detach(interface['index'])
+            self.detach(interface['ifname'])
+            with interface._direct_state:
+                for key in tuple(interface.keys()):
+                    del interface[key]
+            interface._mode = 'invalid'
+        raise error
+
+    def _bulk_apply(self, plan, snapshots, rollback=False):
+        '''
+        Apply transactions of the plan [(interface, transaction)]
+        to the OS, starting from snapshots [(interface, snapshot)].
+        '''
+        addrs = []
+        ports = []
+        links = []
+        removals = []
+        targets = []
+        changed = set()
+        for ((interface, transaction),
+             (x, snapshot)) in zip(plan, snapshots):
+            index = interface['index']
+            removed = snapshot - transaction
+            added = transaction - snapshot
+            interface['ipaddr'].set_target(transaction['ipaddr'])
+            for i in removed['ipaddr']:
+                addrs.append(self.nl._addr_msg('delete', index, i[0], i[1]))
+            for i in added['ipaddr']:
+                addrs.append(self.nl._addr_msg('add', index, i[0], i[1]))
+            if removed['ipaddr'] or added['ipaddr']:
+                targets.append(interface['ipaddr'].target)
+            interface['ports'].set_target(transaction['ports'])
+            for i in removed['ports']:
+                ports.append(self.nl._link_msg('set', index=i, master=0))
+            for i in added['ports']:
+                ports.append(self.nl._link_msg('set', index=i, master=index))
+            if removed['ports'] or added['ports']:
+                changed |= removed['ports'] | added['ports']
+                targets.append(interface['ports'].target)
+            request = IPLinkRequest()
+            for key in added:
+                if key in nla_fields and key != 'removal':
+                    request[key] = added[key]
+            if any([request[x] is not None for x in request]):
+                links.append(self.nl._link_msg('set', index=index,
+                                               **request))
+            if added.get('removal'):
+                interface._load_event.clear()
+                removals.append(self.nl._link_msg('delete', index=index))
+                targets.append(interface._load_event)
+
+        requests = addrs + ports + links + removals
+        results = self.nl.nlm_request_batch(requests, window=_BULK_WINDOW)
+        for (request, ret) in zip(requests, results):
+            if isinstance(ret, NetlinkError):
+                # bypass only errno 99, 'Cannot assign address'
+                # on address removal, see Interface.commit()
+                if ret.code == 99 and request[1] == RTM_DELADDR:
+                    continue
+                raise ret
+            elif isinstance(ret, Exception):
+                raise ret
+        if changed:
+            self.nl.get_links(*changed)
+        self._bulk_wait(targets, self._bulk_timeout(requests))
+
+        if rollback:
+            assert _FAIL_ROLLBACK & _FAIL_MASK
+        else:
+            for ((interface, transaction), (x, snapshot)) in \
+                    zip(plan, snapshots):
+                # an exception will rollback the transaction
+                for cb in interface._callbacks:
+                    cb(snapshot, transaction)
+            assert _FAIL_COMMIT & _FAIL_MASK
+
+    def _bulk_reload(self, interfaces):
+        '''
+        Reload interfaces with pipelined requests
+        '''
+        interfaces = [x for x in interfaces if x._mode != 'invalid']
+        if not interfaces:
+            return
+        for interface in interfaces:
+            interface._load_event.clear()
+        try:
+            self.nl.get_links(*[x['index'] for x in interfaces])
+        except Empty:
+            raise IOError('lost netlink connection')
+        self._bulk_wait([x._load_event for x in interfaces],
+                        self._bulk_timeout(interfaces))
+
+    def _bulk_rollback(self, plan, snapshots, created):
+        '''
+        Roll back all the interfaces of the plan
+        '''
+        for interface in created:
+            interface._load_event.clear()
+        requests = [self.nl._link_msg('delete', index=x['index'])
+                    for x in created]
+        self.nl.nlm_request_batch(requests, window=_BULK_WINDOW)
+        self._bulk_wait([x._load_event for x in created],
+                        self._bulk_timeout(requests))
+        snapshots = [(x, s) for (x, s) in snapshots if x not in created]
+        if not snapshots:
+            for (interface, transaction) in plan:
+                # interfaces, that failed to be created, are
+                # invalidated already by _bulk_create()
+                if interface not in created and \
+                        interface._mode != 'invalid':
+                    interface.drop()
+            return
+        self._bulk_reload([x for (x, s) in snapshots])
+        # see Interface.commit() for the explanation
+        for (interface, snapshot) in snapshots:
+            transaction = interface.last()
+            removed = snapshot - transaction
+            added = transaction - snapshot
+            with interface._direct_state:
+                for i in removed['ipaddr']:
+                    try:
+                        interface['ipaddr'].remove(i)
+                    except KeyError:
+                        pass
+                for i in added['ipaddr']:
+                    interface['ipaddr'].add(i)
+        self._bulk_apply(snapshots,
+                         [(x, x.pick()) for (x, s) in snapshots],
+                         rollback=True)
+        for (interface, snapshot) in snapshots:
+            interface.drop()
+        self._bulk_reload([x for (x, s) in snapshots])
 
     def update_links(self, links):
         '''
@@ -902,7 +2393,7 @@ class IPDB(Dotkeys):
         '''
         for dev in links:
             if dev['index'] not in self.ipaddr:
-                self.ipaddr[dev['index']] = LinkedSet()
+                self.ipaddr[dev['index']] = self._sclass()
             i = \
                 self.by_index[dev['index']] = \
                 self[dev['index']] = \
@@ -912,6 +2403,7 @@ class IPDB(Dotkeys):
             self[i['ifname']] = \
                 self.by_name[i['ifname']] = i
             self.old_names[dev['index']] = i['ifname']
+            self._reindex(i)
 
     def _lookup_master(self, msg):
         index = msg['index']
@@ -952,13 +2444,17 @@ class IPDB(Dotkeys):
                     # no 'RTM_DELLINK', only 'RTM_NEWLINK', and
                     # we can end up in a broken state, when two
                     # masters refers to the same slave
-                    for device in self.by_index:
-                        if index in self[device]['ports']:
-                            self[device].del_port(index, direct=True)
+                    old = self.masters.get(index, None)
+                    if old is not None and old != master['index'] and \
+                            old in self.by_index and \
+                            index in self[old]['ports']:
+                        self[old].del_port(index, direct=True)
                     master.add_port(index, direct=True)
+                    self.masters[index] = master['index']
                 elif msg['event'] == 'RTM_DELLINK':
                     if index in master['ports']:
                         master.del_port(index, direct=True)
+                    self.masters.pop(index, None)
             # there is NO masters for the interface, clean them if any
             else:
                 device = self[msg['index']]
@@ -971,6 +2467,7 @@ class IPDB(Dotkeys):
                     if (master in self) and \
                             (msg['index'] in self[master].ports):
                         self[master].del_port(msg['index'], direct=True)
+                self.masters.pop(msg['index'], None)
 
     def update_addr(self, addrs, action='add'):
         '''
@@ -979,58 +2476,561 @@ class IPDB(Dotkeys):
         for addr in addrs:
             nla = get_addr_nla(addr)
             if nla is not None:
-                method = getattr(self.ipaddr[addr['index']], action)
+                index = addr['index']
+                key = (nla, addr['prefixlen'])
+                known = key in self.ipaddr[index]
+                method = getattr(self.ipaddr[index], action)
                 try:
-                    method(key=(nla, addr['prefixlen']), raw=addr)
+                    method(key=key, raw=addr if self.keep_raw else None)
                 except:
-                    pass
+                    continue
+                if action == 'add' and not known:
+                    self.by_ip.add(nla, index)
+                elif action == 'remove' and known:
+                    self.by_ip.remove(nla, index)
+
+    def _link_changed(self, interface, dev):
+        '''
+        Check if RTM_NEWLINK message differs from the interface
+        data. Volatile items, like statistics, are not compared.
+        '''
+        if interface['flags'] != dev['flags']:
+            return True
+        for (name, value) in dev['attrs']:
+            norm = ifinfmsg.nla2name(name)
+            if norm in interface.cleanup:
+                continue
+            if interface.get(norm, None) != value:
+                return True
+        return False
+
+    def _dump_links(self):
+        # statistics are not stored in the database, so skip
+        # them in the kernel; do not mirror dumps into the
+        # event queue -- otherwise they can overflow it
+        msg = ifinfmsg()
+        msg['family'] = AF_UNSPEC
+        msg['attrs'] = [['IFLA_EXT_MASK', RTEXT_FILTER_SKIP_STATS]]
+        return self.nl.nlm_request(msg, RTM_GETLINK, mirror=False)
+
+    def _dump_addr(self):
+        msg = ifaddrmsg()
+        msg['family'] = AF_UNSPEC
+        return self.nl.nlm_request(msg, RTM_GETADDR, mirror=False)
+
+    def save(self, path):
+        '''
+        Save links and addresses to a snapshot file, to start
+        other IPDB instances with `restore=path`. The snapshot
+        is a sequence of raw RTM_NEWLINK and RTM_NEWADDR
+        messages, dumped from the OS; link messages are
+        stripped with strip_link(). The file is replaced
+        atomically.
+        '''
+        links = self._dump_links()
+        addrs = self._dump_addr()
+        tmp = '%s.%i' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            for msg in links:
+                f.write(strip_link(msg.raw))
+            for msg in addrs:
+                f.write(msg.raw)
+        os.rename(tmp, path)
+
+    def _restore(self, path):
+        '''
+        Load the database from a snapshot and apply the
+        difference with the OS. Return False, if the snapshot
+        can not be used.
+        '''
+        try:
+            with open(path, 'rb') as f:
+                data = io.BytesIO()
+                data.length = data.write(f.read())
+            messages = self.nl.marshal.parse(data)
+        except Exception:
+            return False
+        links = [x for x in messages if x.get('event') == 'RTM_NEWLINK']
+        addrs = [x for x in messages if x.get('event') == 'RTM_NEWADDR']
+        if not links or len(links) + len(addrs) != len(messages) or \
+                [x for x in messages if x['header']['error'] is not None]:
+            return False
+        self.update_links(links)
+        self.update_slaves(links)
+        self.update_addr(addrs)
+        # /sys/class/net is usable only for the local system
+        if self.nl.host.startswith('netlink://') and \
+                os.path.isdir(_SYSFS_NET):
+            try:
+                self._verify()
+                return True
+            except NetlinkError:
+                # some interfaces are removed during the check
+                pass
+        self.resync()
+        return True
+
+    def resync(self):
+        '''
+        Synchronize the database with the OS after the netlink
+        event loss (NLMSG_OVERRUN). Dump links and addresses,
+        compare them with the database and apply only the
+        difference as synthetic RTM_NEWLINK, RTM_DELLINK,
+        RTM_NEWADDR and RTM_DELADDR events.
+
+        Existing interface objects are not rebuilt. Returns the
+        list of applied synthetic events.
+        '''
+        links = self._dump_links()
+        events = [x for x in links
+                  if (x['index'] not in self.by_index) or
+                  self._link_changed(self.by_index[x['index']], x)]
+        return self._sync(events, set([x['index'] for x in links]))
+
+    def _sync(self, events, alive):
+        '''
+        Complete link events with RTM_DELLINK for interfaces
+        not in `alive` and with the difference of addresses,
+        apply them, and reload routes and neighbors.
+        '''
+        # 8<---------------------------------------------
+        # links
+        for index in tuple(self.by_index.keys()):
+            if index not in alive:
+                dev = ifinfmsg()
+                dev['index'] = index
+                dev['change'] = 0xffffffff
+                dev['event'] = 'RTM_DELLINK'
+                events.append(dev)
+
+        # 8<---------------------------------------------
+        # addresses
+        current = {}
+        for addr in self._dump_addr():
+            nla = get_addr_nla(addr)
+            if nla is not None and addr['index'] in alive:
+                key = (nla, addr['prefixlen'])
+                current.setdefault(addr['index'], {})[key] = addr
+        for index in alive:
+            known = self.ipaddr.get(index, set())
+            for (key, addr) in current.get(index, {}).items():
+                if key not in known:
+                    events.append(addr)
+            for key in tuple(known):
+                if key not in current.get(index, {}):
+                    addr = ifaddrmsg()
+                    addr['index'] = index
+                    addr['prefixlen'] = key[1]
+                    if key[0].find(':') > -1:
+                        addr['family'] = AF_INET6
+                        addr['attrs'] = [['IFA_ADDRESS', key[0]]]
+                    else:
+                        addr['family'] = AF_INET
+                        addr['attrs'] = [['IFA_LOCAL', key[0]],
+                                         ['IFA_ADDRESS', key[0]]]
+                    addr['event'] = 'RTM_DELADDR'
+                    events.append(addr)
+
+        self._apply(events)
+        self.reload_routes()
+        self.reload_neighbors()
+        self._record('route', None, {'reload': True})
+        self._record('neighbor', None, {'reload': True})
+        return events
+
+    def _sysfs_links(self):
+        '''
+        Read interfaces from /sys/class/net, return the dict
+        {index: {field: value}} w/ fields named as in IPDB.
+        '''
+        ret = {}
+        names = {}
+        for name in os.listdir(_SYSFS_NET):
+            path = os.path.join(_SYSFS_NET, name)
+            fields = {'ifname': name}
+            try:
+                for (key, attr, convert) in _SYSFS_FIELDS:
+                    with open(os.path.join(path, attr), 'r') as f:
+                        fields[key] = convert(f.read().strip())
+                master = os.path.join(path, 'master')
+                if os.path.islink(master):
+                    master = os.path.basename(os.readlink(master))
+                else:
+                    master = None
+            except (IOError, OSError):
+                # not an interface, or it is removed just now
+                continue
+            fields['master'] = master
+            ret[fields['index']] = fields
+            names[name] = fields['index']
+        for fields in ret.values():
+            fields['master'] = names.get(fields['master'], None)
+        return ret
+
+    @staticmethod
+    def _sysfs_changed(interface, fields):
+        for key in ('ifname', 'mtu', 'address', 'operstate',
+                    'txqlen', 'master'):
+            if interface.get(key, None) != fields[key]:
+                return True
+        return ((interface['flags'] or 0) & ~_IFF_VOLATILE) != \
+            (fields['flags'] & ~_IFF_VOLATILE)
+
+    def _verify(self):
+        '''
+        Compare the database with /sys/class/net, w/o taking
+        the RTNL lock for a link dump, and reload only new
+        and changed interfaces.
+        '''
+        links = self._sysfs_links()
+        stale = [index for (index, fields) in links.items()
+                 if (index not in self.by_index) or
+                 self._sysfs_changed(self.by_index[index], fields)]
+        events = []
+        if stale:
+            events = self.nl.get_links(*stale,
+                                       ext_mask=RTEXT_FILTER_SKIP_STATS)
+        return self._sync(events, set(links))
+
+    def reload_routes(self, family=AF_UNSPEC):
+        '''
+        Reload routing tables of the family from the OS.
+        '''
+        msg = rtmsg()
+        msg['family'] = family
+        routes = self.nl.nlm_request(msg, RTM_GETROUTE, mirror=False)
+        self.routes.load(routes, family or None)
+
+    def reload_neighbors(self):
+        '''
+        Reload ARP and NDP tables from the OS.
+        '''
+        msg = ndmsg()
+        msg['family'] = AF_UNSPEC
+        neighbors = self.nl.nlm_request(msg, RTM_GETNEIGH, mirror=False)
+        self.neighbors.load(neighbors)
+
+    def _apply(self, messages):
+        '''
+        Apply netlink events to the database.
+        '''
+        touched = self._touched(messages) if self._waiters else set()
+        self._apply_messages(messages)
+        if self._waiters:
+            self._wake(touched)
+
+    def _apply_messages(self, messages):
+        for msg in messages:
+            if msg.get('event', None) == 'RTM_NEWLINK':
+                index = msg['index']
+                if index in self:
+                    # get old name
+                    old = self.old_names[index]
+                    snapshot = None
+                    if self._callbacks or self.journal.size:
+                        snapshot = dict(self[index])
+                    # load interface from the message
+                    self[index].load(msg)
+                    # check for new name
+                    if self[index]['ifname'] != old:
+                        # FIXME catch exception
+                        # FIXME isolate dict updates
+                        del self[old]
+                        del self.by_name[old]
+                        if index in self.old_names:
+                            del self.old_names[index]
+                        self[self[index]['ifname']] = self[index]
+                        self.by_name[self[index]['ifname']] = self[index]
+                        self.old_names[index] = self[index]['ifname']
+                    self._reindex(self[index])
+                    if snapshot is not None:
+                        diff = self._diff(snapshot, self[index])
+                        if diff:
+                            self._notify(self[index], diff)
+                            self._record('link', index, diff)
+                else:
+                    self.update_links([msg])
+                    if self._callbacks or self.journal.size:
+                        diff = self._diff({}, self[index])
+                        self._notify(self[index], diff)
+                        self._record('link', index, diff)
+                self.update_slaves([msg])
+                if not msg['flags'] & _IFF_UP:
+                    self.routes.flush(msg['index'])
+                    self.neighbors.flush(msg['index'], permanent=False)
+                # what about removal?
+                self._links_event.set()
+            elif msg.get('event', None) == 'RTM_DELLINK':
+                self.update_slaves([msg])
+                if msg['change'] == 0xffffffff:
+                    if self._callbacks:
+                        self._notify(self[msg['index']], {'removal': True})
+                    self._record('link', msg['index'], {'removal': True})
+                    # FIXME catch exception
+                    self[msg['index']].sync()
+                    del self.by_name[self[msg['index']]['ifname']]
+                    del self.by_index[msg['index']]
+                    del self.old_names[msg['index']]
+                    del self[self[msg['index']]['ifname']]
+                    del self[msg['index']]
+                    self._unindex(msg['index'])
+                    self.routes.flush(msg['index'])
+                    self.neighbors.flush(msg['index'])
+            elif msg.get('event', None) == 'RTM_NEWADDR':
+                known = self._has_addr(msg)
+                self.update_addr([msg], 'add')
+                if not known and self._has_addr(msg):
+                    self._record('addr', msg['index'],
+                                 {'ipaddr': self._has_addr(msg)})
+            elif msg.get('event', None) == 'RTM_DELADDR':
+                known = self._has_addr(msg)
+                self.update_addr([msg], 'remove')
+                if known and not self._has_addr(msg):
+                    self._record('addr', msg['index'],
+                                 {'ipaddr': known, 'removal': True})
+                if msg['family'] == AF_INET:
+                    # IPv4 routes of the address are removed
+                    # silently, the monitor reloads them
+                    self._stale_routes = True
+            elif msg.get('event', None) == 'RTM_NEWROUTE':
+                self.routes.add(msg)
+                self._record_route(msg)
+            elif msg.get('event', None) == 'RTM_DELROUTE':
+                self.routes.remove(msg)
+                self._record_route(msg, {'removal': True})
+            elif msg.get('event', None) == 'RTM_NEWNEIGH':
+                self.neighbors.add(msg)
+                self._record_neighbor(msg)
+            elif msg.get('event', None) == 'RTM_DELNEIGH':
+                self.neighbors.remove(msg)
+                self._record_neighbor(msg, {'removal': True})
+            elif msg.get('event', None) == 'NLMSG_OVERRUN':
+                # some events are lost, so the database can be
+                # out of sync with the OS
+                self.resync()
+
+    def _touched(self, messages):
+        '''
+        Return the set of interface indices and names, that
+        the messages refer to, or None for all interfaces.
+        '''
+        ret = set()
+        for msg in messages:
+            event = msg.get('event', None)
+            if event == 'NLMSG_OVERRUN':
+                return None
+            elif event in _WAKE_INDEX:
+                index = msg[_WAKE_INDEX[event]]
+            elif event in ('RTM_NEWROUTE', 'RTM_DELROUTE'):
+                index = msg.get_attr('RTA_OIF')
+            else:
+                continue
+            ret.add(index)
+            if index in self.old_names:
+                ret.add(self.old_names[index])
+            if event in ('RTM_NEWLINK', 'RTM_DELLINK'):
+                ret.add(msg.get_attr('IFLA_IFNAME'))
+        return ret
+
+    def _wake(self, touched):
+        with self._waiters_lock:
+            for (keys, event) in self._waiters:
+                if keys is None or touched is None or keys & touched:
+                    event.set()
+
+    def wait_for(self, predicate, keys=None, timeout=None):
+        '''
+        Wait until `predicate()` returns True, and return True,
+        or False on timeout::
+
+            ip.wait_for(lambda: ip.eth0.operstate == 'UP',
+                        keys=['eth0'], timeout=5)
+            ip.wait_for(lambda: 'br0' in ip, keys=['br0'])
+
+        The predicate is called with the database lock
+        acquired: at first immediately, and then only when
+        applied events touch `keys` -- names or indices of
+        interfaces, incl. their addresses, neighbors and
+        routes via them. With `keys=None` any event wakes
+        the waiter. KeyError in the predicate is treated as
+        False. Do not call it from callbacks, as they run in
+        the monitor thread.
+        '''
+        event = threading.Event()
+        waiter = (set(keys) if keys is not None else None, event)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._waiters_lock:
+            self._waiters.append(waiter)
+        try:
+            while True:
+                event.clear()
+                with self.lock:
+                    try:
+                        if predicate():
+                            return True
+                    except KeyError:
+                        pass
+                if deadline is None:
+                    event.wait()
+                    continue
+                delay = deadline - time.time()
+                if delay <= 0 or not event.wait(delay):
+                    return False
+        finally:
+            with self._waiters_lock:
+                self._waiters.remove(waiter)
+
+    def _has_addr(self, msg):
+        # return (address, prefixlen) if it is in the database
+        key = (get_addr_nla(msg), msg['prefixlen'])
+        if key in self.ipaddr.get(msg['index'], ()):
+            return key
+        return None
+
+    def _record(self, kind, key, diff):
+        if self.journal.size:
+            self.journal.record(kind, key, diff)
+
+    def _record_route(self, msg, diff=None):
+        if not self.journal.size or msg['flags'] & _RTM_F_CLONED:
+            return
+        location = self.routes._locate(msg)
+        if location is None:
+            return
+        (table, addr, plen, key) = location
+        key = table + (msg.get_attr('RTA_DST'), plen) + key
+        diff = diff or {'gateway': msg.get_attr('RTA_GATEWAY'),
+                        'oif': msg.get_attr('RTA_OIF'),
+                        'priority': msg.get_attr('RTA_PRIORITY')}
+        self.journal.record('route', key, diff)
+
+    def _record_neighbor(self, msg, diff=None):
+        if not self.journal.size or msg['family'] not in _ADDR_BITS:
+            return
+        key = (msg['ifindex'], msg.get_attr('NDA_DST'))
+        diff = diff or {'lladdr': msg.get_attr('NDA_LLADDR'),
+                        'state': msg['state']}
+        self.journal.record('neighbor', key, diff)
+
+    @property
+    def version(self):
+        '''
+        The version of the database, see changes_since()
+        '''
+        return self.journal.version
+
+    def changes_since(self, version, timeout=None):
+        '''
+        Return the list of `Change` records, applied after the
+        version, see `Journal`. The journal should be enabled
+        with IPDB(journal=N)::
+
+            version = ip.version
+            ...
+            changes = ip.changes_since(version)
+            if changes is None:
+                # the journal is overrun, re-read the database
+                ...
+            elif changes:
+                version = changes[-1].version
+
+        With `timeout`, wait for changes up to `timeout`
+        seconds. The journal has its own lock, so consumers
+        never block the monitor thread for long.
+        '''
+        return self.journal.since(version, timeout)
+
+    def _count_flaps(self, messages):
+        '''
+        Account flaps of known interfaces. It should be done
+        before coalescing, that drops intermediate states.
+        '''
+        state = {}
+        for msg in messages:
+            if msg.get('event', None) != 'RTM_NEWLINK' or \
+                    msg['index'] not in self.by_index:
+                continue
+            interface = self.by_index[msg['index']]
+            if msg['index'] not in state:
+                state[msg['index']] = ((interface['flags'] or 0) & _IFF_UP,
+                                       interface['operstate'])
+            new = (msg['flags'] & _IFF_UP, msg.get_attr('IFLA_OPERSTATE'))
+            if state[msg['index']] != new:
+                interface.flap()
+                state[msg['index']] = new
+
+    def _coalesce(self, messages):
+        '''
+        Drop RTM_NEWLINK messages, that are overridden by later
+        RTM_NEWLINK for the same interface and family: AF_BRIDGE
+        port notifications carry only a part of attributes, so
+        they do not override full AF_UNSPEC messages. The first
+        message for a new interface is always kept, as following
+        events can refer it, and RTM_DELLINK stops coalescing.
+        Known interfaces going down are kept also, since the
+        kernel flushes routes then -- unless a later message is
+        "down" as well.
+        '''
+        required = set()
+        created = set()
+        for (num, msg) in enumerate(messages):
+            if msg.get('event', None) == 'RTM_NEWLINK':
+                index = msg['index']
+                if index not in self.by_index and index not in created:
+                    created.add(index)
+                    required.add(num)
+        ret = []
+        seen = {}  # {(index, family): if a later message is "down"}
+        for num in range(len(messages) - 1, -1, -1):
+            msg = messages[num]
+            event = msg.get('event', None)
+            if event == 'RTM_NEWLINK':
+                index = msg['index']
+                key = (index, msg['family'])
+                down = not msg['flags'] & _IFF_UP
+                if key in seen and num not in required and \
+                        (index in created or not down or seen[key]):
+                    continue
+                seen[key] = seen.get(key, False) or down
+            elif event == 'RTM_DELLINK':
+                for key in [x for x in seen if x[0] == msg['index']]:
+                    del seen[key]
+            ret.append(msg)
+        ret.reverse()
+        return ret
 
     def monitor(self):
         '''
         Main monitoring cycle. It gets messages from the
         default iproute queue and updates objects in the
         database.
+
+        All the queued messages are applied as one batch,
+        with the database lock acquired once.
         '''
         while not self._stop:
             try:
                 messages = self.nl.get()
+                queue = self.nl.listeners[0]
+                while len(messages) < _BATCH_MAXSIZE and not queue.empty():
+                    messages.extend(self.nl.get())
             except:
                 continue
-            for msg in messages:
-                if msg.get('event', None) == 'RTM_NEWLINK':
-                    index = msg['index']
-                    if index in self:
-                        # get old name
-                        old = self.old_names[index]
-                        # load interface from the message
-                        self[index].load(msg)
-                        # check for new name
-                        if self[index]['ifname'] != old:
-                            # FIXME catch exception
-                            # FIXME isolate dict updates
-                            del self[old]
-                            del self.by_name[old]
-                            if index in self.old_names:
-                                del self.old_names[index]
-                            self[self[index]['ifname']] = self[index]
-                            self.by_name[self[index]['ifname']] = self[index]
-                            self.old_names[index] = self[index]['ifname']
-                    else:
-                        self.update_links([msg])
-                    self.update_slaves([msg])
-                    # what about removal?
-                    self._links_event.set()
-                elif msg.get('event', None) == 'RTM_DELLINK':
-                    self.update_slaves([msg])
-                    if msg['change'] == 0xffffffff:
-                        # FIXME catch exception
-                        self[msg['index']].sync()
-                        del self.by_name[self[msg['index']]['ifname']]
-                        del self.by_index[msg['index']]
-                        del self.old_names[msg['index']]
-                        del self[self[msg['index']]['ifname']]
-                        del self[msg['index']]
-                elif msg.get('event', None) == 'RTM_NEWADDR':
-                    self.update_addr([msg], 'add')
-                elif msg.get('event', None) == 'RTM_DELADDR':
-                    self.update_addr([msg], 'remove')
+            with self.lock:
+                self._count_flaps(messages)
+                self._apply(self._coalesce(messages))
+            if self._stale_routes:
+                # once per batch and w/o the lock: the dump
+                # can be long with big routing tables
+                self._stale_routes = False
+                try:
+                    self.reload_routes(AF_INET)
+                    self._record('route', None, {'reload': True})
+                except Exception:
+                    self._stale_routes = True
+            # confirm by all the messages, coalesced ones
+            # are overridden by applied ones anyway
+            self._confirm(messages)
+            publisher = self._publisher
+            if publisher is not None:
+                publisher[1].push(None, None)
@@ -30,6 +30,10 @@ classes
 -------
 '''
 
+import time
+import errno
+import threading
+import collections
 from socket import htons
 from socket import AF_INET
 from socket import AF_INET6
@@ -39,10 +43,13 @@ from pyroute2.netlink import NetlinkSocket
 from pyroute2.netlink import NLM_F_ATOMIC
 from pyroute2.netlink import NLM_F_ROOT
 from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink import NLM_F_MULTI
+from pyroute2.netlink import NLMSG_OVERRUN
 from pyroute2.netlink import NLM_F_ACK
-from pyroute2.netlink import NLM_F_DUMP
 from pyroute2.netlink import NLM_F_CREATE
 from pyroute2.netlink import NLM_F_EXCL
+from pyroute2.netlink import NLM_F_REPLACE
+from pyroute2.netlink import NetlinkError
 from pyroute2.netlink.client import Netlink
 from pyroute2.netlink.generic import NETLINK_ROUTE
 from pyroute2.netlink.rtnl.tcmsg import tcmsg
@@ -84,6 +91,15 @@ RTNLGRP_NOP4 = 0x10000
 RTNLGRP_IPV6_PREFIX = 0x20000
 RTNLGRP_IPV6_RULE = 0x40000
 
+AF_BRIDGE = 7
+IFF_UP = 0x1
+
+# IFLA_EXT_MASK filters for link dumps
+RTEXT_FILTER_VF = 0x1
+RTEXT_FILTER_BRVLAN = 0x2
+RTEXT_FILTER_BRVLAN_COMPRESSED = 0x4
+RTEXT_FILTER_SKIP_STATS = 0x8
+
 ## Types of messages
 #RTM_BASE = 16
 RTM_NEWLINK = 16
@@ -174,6 +190,18 @@ rtscopes = {'RT_SCOPE_UNIVERSE': 0,
             'RT_SCOPE_NOWHERE': 255}
 
 
+def _create_flags(msg_type, delete):
+    '''
+    Return NLM_F_CREATE | NLM_F_EXCL for all the requests
+    but deletes. NLM_F_EXCL in delete requests means
+    NLM_F_BULK for recent kernels, and it is not supported
+    for links, addresses and routes.
+    '''
+    if msg_type == delete:
+        return 0
+    return NLM_F_CREATE | NLM_F_EXCL
+
+
 def transform_handle(handle):
     if isinstance(handle, basestring):
         (major, minor) = [int(x if x else '0', 16) for x in handle.split(':')]
@@ -223,6 +251,222 @@ class IPRSocket(NetlinkSocket):
         NetlinkSocket.bind(self, groups)
 
 
+class DumpCache(object):
+    '''
+    Read-through cache for IPRoute dumps. Every kind of objects
+    is loaded with one dump on the first request, and then it is
+    kept up to date with RTM_NEW*/RTM_DEL* broadcast messages.
+
+    Events that arrive during the dump are saved and replayed
+    after it. A store is dropped on NLMSG_OVERRUN and after `ttl`
+    seconds, so the next request redumps it.
+
+    Some NLA are indexed, see `indexes`, so lookups by them do
+    not scan the store.
+
+    Use IPRoute.cache() to enable the cache.
+    '''
+    kinds = {'links': (ifinfmsg, RTM_GETLINK),
+             'addr': (ifaddrmsg, RTM_GETADDR),
+             'neighbors': (ndmsg, RTM_GETNEIGH),
+             'routes': (rtmsg, RTM_GETROUTE),
+             'qdiscs': (tcmsg, RTM_GETQDISC)}
+    events = {RTM_NEWLINK: ('links', False),
+              RTM_DELLINK: ('links', True),
+              RTM_NEWADDR: ('addr', False),
+              RTM_DELADDR: ('addr', True),
+              RTM_NEWNEIGH: ('neighbors', False),
+              RTM_DELNEIGH: ('neighbors', True),
+              RTM_NEWROUTE: ('routes', False),
+              RTM_DELROUTE: ('routes', True),
+              RTM_NEWQDISC: ('qdiscs', False),
+              RTM_DELQDISC: ('qdiscs', True)}
+    indexes = {'links': ('IFLA_IFNAME', 'IFLA_ADDRESS')}
+
+    def __init__(self, ipr, ttl=60):
+        self.ipr = ipr
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.stores = {}    # {kind: {key: msg, ...}, ...}
+        self.ctime = {}     # {kind: load time, ...}
+        self.backlog = {}   # {kind: [msg, ...], ...}
+        self.index = {}     # {kind: {nla: {value: set(key)}}, ...}
+        self.load_locks = dict([(x, threading.Lock()) for x in self.kinds])
+
+    @staticmethod
+    def key(kind, msg):
+        if kind == 'links':
+            return msg['index']
+        elif kind == 'addr':
+            return (msg['family'],
+                    msg['index'],
+                    msg['prefixlen'],
+                    msg.get_attr('IFA_ADDRESS'),
+                    msg.get_attr('IFA_LOCAL'))
+        elif kind == 'neighbors':
+            # AF_BRIDGE FDB records have no NDA_DST
+            dst = msg.get_attr('NDA_DST')
+            return (msg['family'],
+                    msg['ifindex'],
+                    dst,
+                    msg.get_attr('NDA_LLADDR') if dst is None else None)
+        elif kind == 'routes':
+            key = (msg['family'],
+                   msg.get_attr('RTA_TABLE') or msg['table'],
+                   msg['dst_len'],
+                   msg.get_attr('RTA_DST'),
+                   msg['tos'],
+                   msg.get_attr('RTA_PRIORITY'))
+            if msg['family'] == AF_INET6:
+                # IPv6 keeps routes to one prefix with one metric
+                # via different nexthops as separate routes
+                key += (msg.get_attr('RTA_OIF'),
+                        msg.get_attr('RTA_GATEWAY'))
+            return key
+        elif kind == 'qdiscs':
+            return (msg['index'],
+                    msg['handle'],
+                    msg['parent'])
+
+    def get(self, kind):
+        '''
+        Get all the objects of the kind, load them if required
+        '''
+        store = self.load(kind)
+        with self.lock:
+            return list(store.values())
+
+    def lookup(self, kind, nla, value):
+        '''
+        Get sorted keys of objects of the kind, that have
+        the NLA value
+        '''
+        store = self.load(kind)
+        with self.lock:
+            index = self.index.get(kind, {}).get(nla, None)
+            if index is not None and self.stores.get(kind) is store:
+                return sorted(index.get(value, ()))
+            return sorted([key for (key, msg) in store.items()
+                           if msg.get_attr(nla) == value])
+
+    def load(self, kind):
+        '''
+        Return the store of the kind, load it if required
+        '''
+        with self.load_locks[kind]:
+            with self.lock:
+                store = self.stores.get(kind, None)
+                if store is not None and (self.ttl is None or
+                                          time.time() - self.ctime[kind] <
+                                          self.ttl):
+                    return store
+                # start to save events before the dump request
+                self.stores.pop(kind, None)
+                self.index.pop(kind, None)
+                self.backlog[kind] = []
+            try:
+                (msg_class, msg_type) = self.kinds[kind]
+                msg = msg_class()
+                msg['family'] = AF_UNSPEC
+                ret = self.ipr.nlm_request(msg, msg_type)
+            except Exception:
+                with self.lock:
+                    del self.backlog[kind]
+                raise
+            with self.lock:
+                backlog = self.backlog.pop(kind)
+                store = {}
+                for msg in ret:
+                    store[self.key(kind, msg)] = msg
+                for msg in backlog:
+                    if msg is not None:
+                        self.apply(kind, store, msg)
+                # the store was invalidated during the dump,
+                # so return the result, but do not save it
+                if None not in backlog:
+                    self.stores[kind] = store
+                    self.ctime[kind] = time.time()
+                    index = dict([(x, {}) for x in
+                                  self.indexes.get(kind, ())])
+                    for (key, msg) in store.items():
+                        self.update_index(index, key, msg)
+                    self.index[kind] = index
+            return store
+
+    @staticmethod
+    def update_index(index, key, msg, remove=False):
+        for (nla, values) in index.items():
+            value = msg.get_attr(nla)
+            if value is None:
+                continue
+            if remove:
+                keys = values.get(value, set())
+                keys.discard(key)
+                if not keys:
+                    values.pop(value, None)
+            else:
+                values.setdefault(value, set()).add(key)
+
+    def invalidate(self, kind=None):
+        '''
+        Drop the store of the kind, or all the stores
+        '''
+        with self.lock:
+            self._invalidate(kind)
+
+    def _invalidate(self, kind=None):
+        for kind in (kind, ) if kind else self.kinds:
+            self.stores.pop(kind, None)
+            self.index.pop(kind, None)
+            # drop also the store that is being loaded
+            if kind in self.backlog:
+                self.backlog[kind].append(None)
+
+    def apply(self, kind, store, msg, index=None):
+        remove = self.events[msg['header']['type']][1]
+        key = self.key(kind, msg)
+        if index is not None and key in store:
+            self.update_index(index, key, store[key], remove=True)
+        if remove:
+            store.pop(key, None)
+        else:
+            store[key] = msg
+            if index is not None:
+                self.update_index(index, key, msg)
+
+    def handler(self, msg):
+        '''
+        Callback for Netlink.register_callback()
+        '''
+        mtype = msg['header']['type']
+        if mtype == NLMSG_OVERRUN:
+            self.invalidate()
+            return
+        # only broadcasts; dump responses are multipart
+        if mtype not in self.events or \
+                msg['header']['flags'] & NLM_F_MULTI or \
+                msg['header'].get('error', None) is not None:
+            return
+        (kind, remove) = self.events[mtype]
+        if kind == 'links' and msg['family'] == AF_BRIDGE:
+            # bridge port info, not the link itself
+            return
+        with self.lock:
+            if kind in self.backlog:
+                self.backlog[kind].append(msg)
+            elif kind in self.stores:
+                self.apply(kind, self.stores[kind], msg,
+                           self.index.get(kind, None))
+            # IPv4 routes are removed w/o notifications, when
+            # the link goes down or the address is removed
+            if (kind == 'links' and
+                    (remove or not msg['flags'] & IFF_UP)) or \
+                    (kind == 'addr' and remove):
+                self._invalidate('routes')
+            if kind == 'links' and remove:
+                self._invalidate('qdiscs')
+
+
 class IPRoute(Netlink):
     '''
     You can think of this class in some way as of plain old iproute2
@@ -231,6 +475,64 @@ class IPRoute(Netlink):
     marshal = MarshalRtnl
     family = NETLINK_ROUTE
     groups = RTNL_GROUPS
+    # with more keys getters use one dump instead of
+    # pipelined requests, see _get_many()
+    dump_threshold = 64
+    _cache = None
+
+    def cache(self, operate=True, ttl=60):
+        '''
+        Turn the dump cache on/off. With the cache get_links(),
+        get_addr(), get_neighbors(), get_routes() and get_qdiscs()
+        are served from memory, that is loaded with one dump
+        and kept up to date with broadcast messages.
+
+        * ttl -- seconds to redump a store, None to keep it
+          until NLMSG_OVERRUN
+
+        Please note, that returned messages are shared by the
+        cache and should not be modified.
+        '''
+        if operate and self._cache is None:
+            self._subscribe()
+            self._cache = DumpCache(self, ttl)
+            self.register_callback(self._cache.handler)
+        elif not operate and self._cache is not None:
+            self.unregister_callback(self._cache.handler)
+            self._cache = None
+            self._unsubscribe()
+
+    def _get_many(self, msg_type, requests, dump, key):
+        '''
+        Get objects by keys. `requests` is a list of (key, msg)
+        pairs, the requests are pipelined, so there is only one
+        round trip for all of them. For more than `dump_threshold`
+        keys the `dump` request is sent instead, and the result
+        is filtered with `key(msg)`.
+
+        The result follows the order of keys. Unknown keys raise
+        NetlinkError, as in the case of single requests.
+        '''
+        result = []
+        if len(requests) > self.dump_threshold:
+            objects = {}
+            for msg in self.nlm_request(dump, msg_type):
+                objects[key(msg)] = msg
+            for (k, msg) in requests:
+                if k not in objects:
+                    raise NetlinkError(errno.ENODEV)
+                result.append(objects[k])
+            return result
+        # responses are much bigger than ACKs, so the window is
+        # smaller than for modifying requests, not to overflow
+        # the socket buffer
+        for ret in self.nlm_request_batch([(msg, msg_type, NLM_F_REQUEST)
+                                           for (k, msg) in requests],
+                                          window=32):
+            if isinstance(ret, Exception):
+                raise ret
+            result.extend(ret)
+        return result
 
     # 8<---------------------------------------------------------------
     #
@@ -241,9 +543,15 @@ class IPRoute(Netlink):
         Get all queue disciplines for all interfaces or for specified
         one.
         '''
-        msg = tcmsg()
-        msg['family'] = AF_UNSPEC
-        ret = self.nlm_request(msg, RTM_GETQDISC)
+        if self._cache is not None:
+            ret = self._cache.get('qdiscs')
+        else:
+            msg = tcmsg()
+            msg['family'] = AF_UNSPEC
+            # the kernel can filter the dump by the interface index,
+            # but the result is filtered here anyway for old kernels
+            msg['index'] = index or 0
+            ret = self.nlm_request(msg, RTM_GETQDISC)
         if index is None:
             return ret
         else:
@@ -269,7 +577,7 @@ class IPRoute(Netlink):
         msg['index'] = index
         return self.nlm_request(msg, RTM_GETTCLASS)
 
-    def get_links(self, *argv):
+    def get_links(self, *argv, **kwarg):
         '''
         Get network interfaces.
 
@@ -283,34 +591,68 @@ class IPRoute(Netlink):
 
             interfaces = [1, 2, 3]
             ip.get_links(*interfaces)
+
+        Optional `ext_mask` keyword is sent as IFLA_EXT_MASK,
+        see RTEXT_FILTER_* constants::
+
+            ip.get_links(ext_mask=RTEXT_FILTER_SKIP_STATS)
+
+        Requests for several indices are pipelined, and for
+        more than `dump_threshold` indices one dump is used.
         '''
-        result = []
-        links = argv or ['all']
-        msg_flags = NLM_F_REQUEST | NLM_F_DUMP
-        for index in links:
+        ext_mask = kwarg.get('ext_mask', None)
+        if self._cache is not None and ext_mask is None:
+            links = self._cache.get('links')
+            if 'all' in argv or not argv:
+                return sorted(links, key=lambda x: x['index'])
+            links = dict([(x['index'], x) for x in links])
+            if [x for x in argv if x not in links]:
+                # the same as the kernel responds w/o the cache
+                raise NetlinkError(errno.ENODEV)
+            return [links[x] for x in argv]
+
+        def request(index=0):
             msg = ifinfmsg()
             msg['family'] = AF_UNSPEC
-            if index != 'all':
-                msg['index'] = index
-                msg_flags = NLM_F_REQUEST
-            result.extend(self.nlm_request(msg, RTM_GETLINK, msg_flags))
-        return result
+            msg['index'] = index
+            if ext_mask is not None:
+                msg['attrs'].append(['IFLA_EXT_MASK', ext_mask])
+            return msg
+
+        if 'all' in argv or not argv:
+            return self.nlm_request(request(), RTM_GETLINK)
+        return self._get_many(RTM_GETLINK,
+                              [(x, request(x)) for x in argv],
+                              request(),
+                              lambda x: x['index'])
 
     def get_neighbors(self, family=AF_UNSPEC):
         '''
         Retrieve ARP cache records.
         '''
+        if self._cache is not None:
+            return [x for x in self._cache.get('neighbors')
+                    if family in (AF_UNSPEC, x['family'])]
         msg = ndmsg()
         msg['family'] = family
         return self.nlm_request(msg, RTM_GETNEIGH)
 
-    def get_addr(self, family=AF_UNSPEC):
+    def get_addr(self, family=AF_UNSPEC, index=None):
         '''
-        Get all addresses.
+        Get all addresses, or addresses of the interface.
         '''
-        msg = ifaddrmsg()
-        msg['family'] = family
-        return self.nlm_request(msg, RTM_GETADDR)
+        if self._cache is not None:
+            ret = [x for x in self._cache.get('addr')
+                   if family in (AF_UNSPEC, x['family'])]
+        else:
+            msg = ifaddrmsg()
+            msg['family'] = family
+            msg['index'] = index or 0
+            ret = self.nlm_request(msg, RTM_GETADDR)
+        if index is None:
+            return ret
+        else:
+            return [x for x in ret if x['index'] == index]
 
     def get_rules(self, family=AF_UNSPEC):
         '''
@@ -328,9 +670,9 @@ class IPRoute(Netlink):
 
     def get_routes(self, family=AF_UNSPEC, **kwarg):
         '''
-        Get all routes. You can specify the table. There
-        are 255 routing classes (tables), and the kernel
-        returns all the routes on each request. So the
+        Get all routes. You can specify the table and the
+        output interface. Kernels that support strict dump
+        checks filter routes themselves, for older ones the
         routine filters routes from full output.
 
         Example::
@@ -338,23 +680,29 @@ class IPRoute(Netlink):
             ip.get_routes()  # get all the routes for all families
             ip.get_routes(family=AF_INET6)  # get only IPv6 routes
             ip.get_routes(table=254)  # get routes from 254 table
+            ip.get_routes(oif=2)  # get routes via interface 2
         '''
 
-        kwarg['table'] = kwarg.get('table', None)
-        msg = rtmsg()
-        msg['family'] = family
-        # you can specify the table here, but the kernel
-        # will ignore this setting
-        msg['table'] = kwarg['table'] or 0
-
-        for key in kwarg:
-            nla = rtmsg.name2nla(key)
-            if kwarg[key] is not None:
-                msg['attrs'].append([nla, kwarg[key]])
-
-        return [x for x in self.nlm_request(msg, RTM_GETROUTE)
-                if x.get_attr('RTA_TABLE') == kwarg['table'] or
-                kwarg['table'] is None]
+        table = kwarg.get('table', None)
+        oif = kwarg.get('oif', None)
+        if self._cache is not None:
+            ret = [x for x in self._cache.get('routes')
+                   if family in (AF_UNSPEC, x['family'])]
+        else:
+            msg = rtmsg()
+            msg['family'] = family
+            # only these fields are accepted by the kernel
+            # in dump requests with strict checks
+            if table is not None:
+                msg['table'] = table if table < 256 else 252
+                msg['attrs'].append(['RTA_TABLE', table])
+            if oif is not None:
+                msg['attrs'].append(['RTA_OIF', oif])
+            ret = self.nlm_request(msg, RTM_GETROUTE)
+
+        return [x for x in ret
+                if (table is None or x.get_attr('RTA_TABLE') == table) and
+                (oif is None or x.get_attr('RTA_OIF') == oif)]
     # 8<---------------------------------------------------------------
 
     # 8<---------------------------------------------------------------
@@ -404,6 +752,9 @@ class IPRoute(Netlink):
 
         Please note, that link_lookup() returns list, not one
         value.
+
+        With the cache enabled, see IPRoute.cache(), lookups by
+        ifname and address use indexes and do not send requests.
         '''
         name = tuple(kwarg.keys())[0]
         value = kwarg[name]
@@ -412,8 +763,30 @@ class IPRoute(Netlink):
         if not name.startswith('IFLA_'):
             name = 'IFLA_%s' % (name)
 
+        if self._cache is not None:
+            return self._cache.lookup('links', name, value)
+
+        if name == 'IFLA_IFNAME':
+            # single object request instead of the full dump
+            msg = ifinfmsg()
+            msg['family'] = AF_UNSPEC
+            msg['attrs'] = [['IFLA_IFNAME', value],
+                            ['IFLA_EXT_MASK', RTEXT_FILTER_SKIP_STATS]]
+            try:
+                links = self.nlm_request(msg, RTM_GETLINK, NLM_F_REQUEST)
+            except NetlinkError:
+                # no such device
+                return []
+            # old kernels can ignore the name
+            return [k['index'] for k in links
+                    if k.get_attr('IFLA_IFNAME') == value]
+
+        if not name.startswith('IFLA_STATS'):
+            links = self.get_links(ext_mask=RTEXT_FILTER_SKIP_STATS)
+        else:
+            links = self.get_links()
         return [k['index'] for k in
-                [i for i in self.get_links() if 'attrs' in i] if
+                [i for i in links if 'attrs' in i] if
                 [l for l in k['attrs'] if l[0] == name and l[1] == value]]
     # 8<---------------------------------------------------------------
 
@@ -457,13 +830,19 @@ class IPRoute(Netlink):
 
             ip.link("delete", index=x)
         '''
+        return self.nlm_request(*self._link_msg(command, **kwarg))
 
+    def _link_msg(self, command, **kwarg):
+        '''
+        Build a link request, return (msg, msg_type, msg_flags)
+        '''
         commands = {'set': RTM_SETLINK,      # almost all operations
                     'add': RTM_NEWLINK,      # no idea, how to use it :)
                     'delete': RTM_DELLINK}   # remove interface
         command = commands.get(command, command)
 
-        msg_flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL
+        msg_flags = NLM_F_REQUEST | NLM_F_ACK | \
+            _create_flags(command, RTM_DELLINK)
         msg = ifinfmsg()
         # index is required
         msg['index'] = kwarg.get('index')
@@ -485,7 +864,7 @@ class IPRoute(Netlink):
             if kwarg[key] is not None:
                 msg['attrs'].append([nla, kwarg[key]])
 
-        return self.nlm_request(msg, msg_type=command, msg_flags=msg_flags)
+        return (msg, command, msg_flags)
 
     def addr(self, command, index, address, mask=24, family=None, scope=0):
         '''
@@ -504,12 +883,20 @@ class IPRoute(Netlink):
             ip.addr("add", index, address="10.0.0.1", mask=24)
             ip.addr("add", index, address="10.0.0.2", mask=24)
         '''
+        return self.nlm_request(*self._addr_msg(command, index, address,
+                                                mask, family, scope))
 
+    def _addr_msg(self, command, index, address, mask=24, family=None,
+                  scope=0):
+        '''
+        Build an address request, return (msg, msg_type, msg_flags)
+        '''
         commands = {'add': RTM_NEWADDR,
                     'delete': RTM_DELADDR}
         command = commands.get(command, command)
 
-        flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL
+        flags = NLM_F_REQUEST | NLM_F_ACK | \
+            _create_flags(command, RTM_DELADDR)
 
         # try to guess family, if it is not forced
         if family is None and address.find(":") > -1:
@@ -527,7 +914,7 @@ class IPRoute(Netlink):
                             ['IFA_ADDRESS', address]]
         elif family == AF_INET6:
             msg['attrs'] = [['IFA_ADDRESS', address]]
-        return self.nlm_request(msg, msg_type=command, msg_flags=flags)
+        return (msg, command, flags)
 
     def tc(self, command, kind, index, handle=0, **kwarg):
         '''
@@ -689,7 +1076,7 @@ class IPRoute(Netlink):
         '''
         Route operations
 
-        * command -- add, delete
+        * command -- add, replace, delete
         * prefix -- route prefix
         * mask -- route prefix mask
         * rtype -- route type (default: "RTN_UNICAST")
@@ -710,17 +1097,91 @@ class IPRoute(Netlink):
 
             ip.route("add", prefix="10.0.0.0", mask=24, gateway="192.168.0.1")
         '''
+        return self.nlm_request(*self._route_msg(command, prefix, mask,
+                                                 rtype, rtproto, rtscope,
+                                                 index, family, **kwarg))
 
+    def route_batch(self, specs, window=128, response_timeout=None):
+        '''
+        Bulk route operations. Requests are streamed to the
+        kernel in batches, with not more than `window` requests
+        waiting for ACK.
+
+        * specs -- iterable of dicts with route() arguments;
+          the default command is "add"
+        * window -- max number of requests in flight
+
+        An error does not abort the batch. Returns a dict with
+        the number of processed specs, the list of errors as
+        (spec number, spec, exception) tuples, time spent and
+        the rate, routes per second.
+
+        Example::
+
+            specs = ({'prefix': '10.0.%i.0' % x,
+                      'mask': 24,
+                      'gateway': '192.168.0.1'} for x in range(256))
+            ret = ip.route_batch(specs)
+            for (num, spec, error) in ret['errors']:
+                ...
+        '''
+        ret = {'total': 0,
+               'errors': [],
+               'time': 0,
+               'rate': 0}
+        numbers = collections.deque()
+
+        def requests():
+            for spec in specs:
+                num = ret['total']
+                ret['total'] += 1
+                spec = dict(spec)
+                try:
+                    msg = self._route_msg(spec.pop('command', 'add'),
+                                          **spec)
+                except Exception as e:
+                    ret['errors'].append((num, spec, e))
+                    continue
+                numbers.append((num, spec))
+                yield msg
+
+        start = time.time()
+        for result in self.nlm_request_iter(requests(),
+                                            response_timeout=response_timeout,
+                                            window=window):
+            (num, spec) = numbers.popleft()
+            if isinstance(result, Exception):
+                ret['errors'].append((num, spec, result))
+        ret['errors'].sort(key=lambda x: x[0])
+        ret['time'] = time.time() - start
+        if ret['time'] > 0:
+            ret['rate'] = ret['total'] / ret['time']
+        return ret
+
+    def _route_msg(self, command, prefix, mask, rtype='RTN_UNICAST',
+                   rtproto='RTPROT_STATIC', rtscope='RT_SCOPE_UNIVERSE',
+                   index=None, family=AF_INET, **kwarg):
+        '''
+        Build a route request, return (msg, msg_type, msg_flags)
+        '''
         commands = {'add': RTM_NEWROUTE,
+                    'replace': RTM_NEWROUTE,
                     'delete': RTM_DELROUTE}
+        flags = NLM_F_REQUEST | NLM_F_ACK
+        if command == 'replace':
+            flags |= NLM_F_CREATE | NLM_F_REPLACE
         command = commands.get(command, command)
+        if not flags & NLM_F_REPLACE:
+            flags |= _create_flags(command, RTM_DELROUTE)
 
-        flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL
         msg = rtmsg()
         # table is mandatory; by default == 254
         # if table is not defined in kwarg, save it there
         # also for nla_attr:
-        msg['table'] = kwarg['table'] = kwarg.get('table', 254)
+        kwarg['table'] = kwarg.get('table', 254)
+        # rtm_table is one byte, use RT_TABLE_COMPAT for
+        # bigger ids, the kernel takes them from RTA_TABLE
+        msg['table'] = kwarg['table'] if kwarg['table'] < 256 else 252
         msg['family'] = family
         msg['proto'] = rtprotos[rtproto]
         msg['type'] = rtypes[rtype]
@@ -733,8 +1194,7 @@ class IPRoute(Netlink):
             if kwarg[key] is not None:
                 msg['attrs'].append([nla, kwarg[key]])
 
-        return self.nlm_request(msg, msg_type=command,
-                                msg_flags=flags)
+        return (msg, command, flags)
 
     def rule(self, command, table, priority=32000, rtype='RTN_UNICAST',
              rtscope='RT_SCOPE_UNIVERSE', family=AF_INET, src=None):
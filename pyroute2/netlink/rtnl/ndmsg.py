@@ -9,6 +9,8 @@ class ndmsg(nlmsg):
 
     struct ndmsg {
         unsigned char ndm_family;
+        unsigned char ndm_pad1;
+        unsigned short ndm_pad2;
         int           ndm_ifindex;  /* Interface index */
         __u16         ndm_state;    /* State */
         __u8          ndm_flags;    /* Flags */
@@ -23,6 +25,8 @@ class ndmsg(nlmsg):
     };
     '''
     fields = (('family', 'B'),
+              ('__pad1', 'B'),
+              ('__pad2', 'H'),
               ('ifindex', 'i'),
               ('state', 'H'),
               ('flags', 'B'),
@@ -1,7 +1,18 @@
+import os
+import time
+import socket
+import threading
+import subprocess
 from pyroute2 import IPDB
+from pyroute2 import IPDBView
 from pyroute2.common import basestring
 from pyroute2.netlink import NetlinkError
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+from pyroute2.netlink.rtnl.ifaddrmsg import ifaddrmsg
 from pyroute2.netlink.ipdb import clear_fail_bit
+from pyroute2.netlink.ipdb import AddressIndex
+from pyroute2.netlink.ipdb import AddressSet
+from pyroute2.netlink.ipdb import Journal
 from pyroute2.netlink.ipdb import set_fail_bit
 from pyroute2.netlink.ipdb import set_ancient
 from pyroute2.netlink.ipdb import _FAIL_COMMIT
@@ -153,6 +164,23 @@ class TestExplicit(object):
         assert len([i for i in r if r[i] is not None]) == 4
         self.ip.lo.drop()
 
+    def test_dirty_keys(self):
+        require_user('root')
+        txqlen = self.ip.dummyX.txqlen
+        if self.ip.dummyX._mode == 'explicit':
+            self.ip.dummyX.begin()
+        self.ip.dummyX.mtu = 1280
+        assert self.ip.dummyX.last()._dirty == set(['mtu'])
+        # change the interface outside of the transaction
+        self.ip.nl.link('set', index=self.ip.dummyX.index,
+                        txqlen=txqlen + 100)
+        self.ip.dummyX.reload()
+        assert self.ip.dummyX.txqlen == txqlen + 100
+        # only the changed key is applied
+        self.ip.dummyX.commit()
+        assert self.ip.dummyX.mtu == 1280
+        assert self.ip.dummyX.txqlen == txqlen + 100
+
     def test_rename(self):
         require_user('root')
         assert 'bala' not in self.ip
@@ -303,6 +331,68 @@ class TestExplicit(object):
         assert self.ip.bala_port0.index not in self.ip.bala.ports
         assert self.ip.bala_port1.index not in self.ip.bala.ports
 
+    def test_bulk_commit(self):
+        require_user('root')
+
+        def prepare():
+            for (name, addr) in (('bala', '172.16.0.1/24'),
+                                 ('bv101', '172.16.1.1/24')):
+                i = self.ip.create(kind='bridge', ifname=name)
+                i.add_ip(addr)
+                i.add_port(self.ip.dummyX)
+            self.ip.dummyX.begin()
+            self.ip.dummyX.add_ip('172.16.2.1/24')
+
+        # the bulk commit fails and is rolled back as a unit
+        prepare()
+        clear_fail_bit(_FAIL_COMMIT)
+        try:
+            self.ip.commit('bala', 'bv101', 'dummyX')
+        except AssertionError:
+            pass
+        else:
+            raise Exception('commit should fail')
+        finally:
+            set_fail_bit(_FAIL_COMMIT)
+
+        assert 'bala' not in self.ip
+        assert 'bv101' not in self.ip
+        assert ('172.16.2.1', 24) not in self.ip.dummyX.ipaddr
+        assert '172.16.2.1/24' not in get_ip_addr(interface='dummyX')
+
+        # now all the interfaces are committed at once
+        prepare()
+        self.ip.bala.del_port(self.ip.dummyX)
+        self.ip.commit()
+        assert ('172.16.0.1', 24) in self.ip.bala.ipaddr
+        assert ('172.16.1.1', 24) in self.ip.bv101.ipaddr
+        assert ('172.16.2.1', 24) in self.ip.dummyX.ipaddr
+        assert '172.16.1.1/24' in get_ip_addr(interface='bv101')
+        assert self.ip.dummyX.index in self.ip.bv101.ports
+        assert self.ip.dummyX.index not in self.ip.bala.ports
+
+    def test_bulk_create_timeout(self):
+        require_user('root')
+
+        def timeout(events, timeout):
+            if events:
+                raise AssertionError('timeout')
+
+        self.ip._bulk_wait = timeout
+        self.ip.create(kind='bridge', ifname='bala')
+        self.ip.create(kind='bridge', ifname='bv101')
+        try:
+            self.ip.commit('bala', 'bv101')
+        except AssertionError:
+            pass
+        else:
+            raise Exception('commit should fail')
+        finally:
+            del self.ip._bulk_wait
+        # the interfaces are created, but must be removed
+        assert not self.ip.nl.link_lookup(ifname='bala')
+        assert not self.ip.nl.link_lookup(ifname='bv101')
+
     def test_create_fail(self):
         require_user('root')
         assert 'bala' not in self.ip
@@ -327,6 +417,48 @@ class TestExplicit(object):
         assert ('172.16.0.1', 24) in self.ip.bala.ipaddr
         assert '172.16.0.1/24' in get_ip_addr(interface='bala')
 
+    def test_create_targeted(self):
+        require_user('root')
+        # commit should wait only for the interface it creates,
+        # not for the global links event
+        self.ip._links_event.set = lambda: None
+        i = self.ip.create(kind='bridge', ifname='bala')
+        i.add_ip('172.16.0.1/24')
+        i.commit()
+        assert ('172.16.0.1', 24) in self.ip.bala.ipaddr
+        assert '172.16.0.1/24' in get_ip_addr(interface='bala')
+
+    def test_concurrent_commits(self):
+        require_user('root')
+        errors = []
+
+        def configure(name, net):
+            try:
+                i = self.ip[name]
+                for x in range(5):
+                    i.begin()
+                    i.add_ip('172.16.%i.%i/24' % (net, x + 1))
+                    i.commit()
+            except Exception as e:
+                errors.append(e)
+
+        for name in ('bala', 'bv101'):
+            with self.ip.create(kind='bridge', ifname=name):
+                pass
+        threads = [threading.Thread(target=configure, args=x)
+                   for x in (('bala', 0), ('bv101', 1))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        for (name, net) in (('bala', 0), ('bv101', 1)):
+            for x in range(5):
+                assert ('172.16.%i.%i' % (net, x + 1), 24) in \
+                    self.ip[name].ipaddr
+        # every confirmation is released
+        assert not self.ip._confirmations
+
     def test_create_and_remove(self):
         require_user('root')
         assert 'bala' not in self.ip
@@ -523,6 +655,204 @@ class TestMisc(object):
             assert ('172.16.0.1', 24) in ip.dummyX.ipaddr
             assert ('172.16.9.1', 24) not in ip.dummyX.ipaddr
 
+    def test_resync(self):
+        with IPDB() as ip:
+            lo = ip.lo
+            # simulate lost events
+            ip.ipaddr[1].remove(('127.0.0.1', 8))
+            ip.lo.set_item('mtu', 1)
+            events = ip.resync()
+            assert len(events) == 2
+            assert ('127.0.0.1', 8) in ip.lo.ipaddr
+            assert ip.lo.mtu != 1
+            # objects are not rebuilt
+            assert ip.lo is lo
+
+    def _wait(self, predicate):
+        for _ in range(30):
+            if predicate():
+                return
+            time.sleep(0.1)
+        raise AssertionError('timeout')
+
+    def test_routes(self):
+        require_user('root')
+        with IPDB() as ip:
+            with ip.dummyX as i:
+                i.add_ip('172.16.0.1/24')
+                i.up()
+            ip.nl.route('add', prefix='172.16.1.0', mask=24,
+                        gateway='172.16.0.2')
+            ip.nl.route('add', prefix='172.16.1.128', mask=25,
+                        gateway='172.16.0.3')
+            self._wait(lambda: ip.routes.lookup('172.16.1.200') and
+                       ip.routes.lookup('172.16.1.200')['dst_len'] == 25)
+            route = ip.routes.lookup('172.16.1.5')
+            assert route.get_attr('RTA_GATEWAY') == '172.16.0.2'
+            assert [x['dst_len'] for x in
+                    ip.routes.match('172.16.1.200')][:2] == [25, 24]
+            assert ip.routes.lookup('127.0.0.1', table=255) is not None
+            ip.nl.route('delete', prefix='172.16.1.128', mask=25,
+                        gateway='172.16.0.3')
+            self._wait(lambda: ip.routes.lookup('172.16.1.200')['dst_len'] ==
+                       24)
+            # IPv6 routes to one prefix via several interfaces
+            subprocess.call(['ip', '-6', 'route', 'add',
+                             '2001:db8:2::/64', 'dev', 'lo'])
+            subprocess.call(['ip', '-6', 'route', 'append',
+                             '2001:db8:2::/64', 'dev', 'dummyX'])
+
+            def oifs():
+                return set([x.get_attr('RTA_OIF') for x in
+                            ip.routes.match('2001:db8:2::1')
+                            if x['dst_len'] == 64])
+
+            self._wait(lambda: oifs() == set((1, ip.dummyX.index)))
+            subprocess.call(['ip', '-6', 'route', 'del',
+                             '2001:db8:2::/64', 'dev', 'lo'])
+            self._wait(lambda: oifs() == set((ip.dummyX.index, )))
+            # routes are removed silently with the link going down
+            with ip.dummyX as i:
+                i.down()
+            self._wait(lambda: not [x for x in ip.routes.match('172.16.1.5')
+                                    if x['dst_len'] == 24])
+
+    def test_routes_reload(self):
+        require_user('root')
+        with IPDB() as ip:
+            calls = []
+            ip.reload_routes = lambda family=0: calls.append(family)
+            events = []
+            for address in ('172.16.0.1', '172.16.0.2'):
+                msg = ifaddrmsg()
+                msg['family'] = socket.AF_INET
+                msg['index'] = ip.dummyX.index
+                msg['prefixlen'] = 24
+                msg['attrs'] = [['IFA_LOCAL', address],
+                                ['IFA_ADDRESS', address]]
+                msg['event'] = 'RTM_DELADDR'
+                events.append(msg)
+            # no dumps with the lock held
+            with ip.lock:
+                ip._apply(events)
+            assert not calls
+            # one reload by the monitor for the next batch
+            with ip.dummyX as i:
+                i.up()
+            self._wait(lambda: calls)
+            assert calls == [socket.AF_INET]
+
+    def test_neighbors(self):
+        require_user('root')
+        with IPDB() as ip:
+            with ip.dummyX as i:
+                i.add_ip('172.16.0.1/24')
+                i.up()
+            index = ip.dummyX.index
+            for addr in ('172.16.0.5', '172.16.0.6'):
+                subprocess.call(['ip', 'neigh', 'add', addr, 'lladdr',
+                                 '00:11:22:33:44:55', 'dev', 'dummyX'])
+            self._wait(lambda: len(ip.neighbors.by_lladdr(
+                '00:11:22:33:44:55')) == 2)
+            entry = ip.neighbors.get(index, '172.16.0.5')
+            assert entry.lladdr == '00:11:22:33:44:55'
+            assert entry.family == socket.AF_INET
+            subprocess.call(['ip', 'neigh', 'del', '172.16.0.5',
+                             'dev', 'dummyX'])
+            self._wait(lambda: ip.neighbors.get(index, '172.16.0.5') is None)
+            assert [x.dst for x in
+                    ip.neighbors.by_lladdr('00:11:22:33:44:55')] == \
+                ['172.16.0.6']
+            assert [x.dst for x in ip.neighbors.by_ifindex(index)] == \
+                ['172.16.0.6']
+
+    def test_indexes(self):
+        require_user('root')
+        with IPDB() as ip:
+            assert ip.by_ip['127.0.0.1'] == set([1])
+            assert 1 in ip.by_address[ip.lo.address]
+            assert 1 in ip.by_operstate[ip.lo.operstate]
+            for name in ('bala', 'bv101'):
+                subprocess.call(['ip', 'link', 'add', name,
+                                 'type', 'bridge'])
+            subprocess.call(['ip', 'link', 'set', 'dummyX',
+                             'master', 'bala'])
+            self._wait(lambda: 'bv101' in ip and
+                       ip.masters.get(ip.dummyX.index, None) ==
+                       ip.bala.index)
+            port = ip.dummyX.index
+            assert ip.by_kind['bridge'] >= set((ip.bala.index,
+                                                ip.bv101.index))
+            assert ip.masters[port] == ip.bala.index
+            # move the port to another master
+            subprocess.call(['ip', 'link', 'set', 'dummyX',
+                             'master', 'bv101'])
+            self._wait(lambda: ip.masters[port] == ip.bv101.index)
+            assert port not in ip.bala.ports
+            assert port in ip.bv101.ports
+            # remove the master
+            index = ip.bv101.index
+            remove_link('bv101')
+            self._wait(lambda: index not in ip.by_index)
+            assert ip.masters.get(port, None) != index
+            assert index not in ip.by_kind['bridge']
+            remove_link('bala')
+
+    def test_coalesce(self):
+        with IPDB() as ip:
+            lo = ip.nl.get_links(1)[0]
+            events = []
+            for flags in (1, 0, 1, 1):
+                msg = ifinfmsg()
+                msg.update(lo)
+                msg['flags'] = flags
+                msg['event'] = 'RTM_NEWLINK'
+                events.append(msg)
+            # a new interface
+            new = ifinfmsg()
+            new.update(lo)
+            new['index'] = 0xffff
+            new['event'] = 'RTM_NEWLINK'
+            events.insert(1, new)
+            events.append(new)
+            ret = ip._coalesce(events)
+            # the last "down" before "up" is kept,
+            # as well as the first new interface message
+            assert ret == [new, events[2], events[4], events[5]]
+            # a partial AF_BRIDGE port message does not override
+            # the full one
+            port = ifinfmsg()
+            port.update(lo)
+            port['family'] = socket.AF_BRIDGE
+            port['event'] = 'RTM_NEWLINK'
+            ret = ip._coalesce([events[0], port])
+            assert ret == [events[0], port]
+            ret = ip._coalesce([events[0], port, events[3]])
+            assert ret == [port, events[3]]
+
+    def test_change_callbacks(self):
+        require_user('root')
+        plain = []
+        coalesced = []
+        with IPDB() as ip:
+            ip.register_callback(lambda i, diff: plain.append(diff))
+            ip.register_callback(lambda i, diff: coalesced.append(diff),
+                                 window=1)
+            for mtu in (1280, 1300, 1400):
+                subprocess.call(['ip', 'link', 'set', 'dummyX',
+                                 'mtu', str(mtu)])
+            for _ in range(3):
+                subprocess.call(['ip', 'link', 'set', 'dummyX', 'up'])
+                subprocess.call(['ip', 'link', 'set', 'dummyX', 'down'])
+            self._wait(lambda: coalesced and
+                       coalesced[-1].get('flags', None) is not None and
+                       not coalesced[-1]['flags'] & 1 and
+                       coalesced[-1].get('mtu', None) == 1400)
+            assert len(coalesced) <= 2
+            assert len(plain) > len(coalesced)
+            assert ip.dummyX.flap_stats['flaps'] >= 6
+            assert ip.dummyX.flap_stats['penalty'] > 1
+
     def test_modes(self):
         with IPDB(mode='explicit') as i:
             # transaction required
@@ -545,3 +875,174 @@ class TestMisc(object):
                 i.lo.up()
             except TypeError:
                 pass
+
+    def test_readonly(self):
+        require_user('root')
+        with IPDB(mode='readonly') as ip:
+            assert ip.lo.ifname == 'lo'
+            assert ('127.0.0.1', 8) in ip.lo.ipaddr
+            for write in (lambda: ip.lo.__setitem__('mtu', 1280),
+                          lambda: setattr(ip.lo, 'mtu', 1280),
+                          lambda: setattr(ip.lo, 'vlan_id', 5),
+                          lambda: ip.lo.add_ip('172.16.0.1/24'),
+                          ip.lo.begin,
+                          lambda: ip.create(kind='bridge', ifname='bala'),
+                          ip.commit):
+                try:
+                    write()
+                except TypeError:
+                    pass
+                else:
+                    raise Exception('write should fail')
+            # the database still follows the OS
+            ip.nl.addr('add', ip.dummyX.index, '172.16.0.1', 24)
+            self._wait(lambda: ('172.16.0.1', 24) in ip.dummyX.ipaddr)
+            assert ip.dummyX.index in ip.by_ip['172.16.0.1']
+
+    def test_save_restore(self):
+        require_user('root')
+        snapshot = '/tmp/ipdb-test-%i.snapshot' % os.getpid()
+        try:
+            with IPDB() as ip:
+                ip.save(snapshot)
+                index = ip.dummyX.index
+                # change the system after the snapshot is taken
+                ip.nl.link('set', index=index, mtu=1280)
+                ip.nl.addr('add', index, '172.16.0.1', 24)
+            with IPDB(restore=snapshot) as ip:
+                assert ip.lo.ifname == 'lo'
+                assert ('127.0.0.1', 8) in ip.lo.ipaddr
+                assert ip.dummyX.mtu == 1280
+                assert ('172.16.0.1', 24) in ip.dummyX.ipaddr
+            # a broken snapshot is ignored
+            with open(snapshot, 'wb') as f:
+                f.write(b'\x10\x00\x00\x00')
+            with IPDB(restore=snapshot) as ip:
+                assert ip.dummyX.mtu == 1280
+        finally:
+            os.unlink(snapshot)
+
+    def test_journal(self):
+        require_user('root')
+        with IPDB() as ip:
+            # disabled by default
+            assert ip.journal.size == 0
+        with IPDB(journal=4096) as ip:
+            index = ip.dummyX.index
+            version = ip.version
+            ip.nl.link('set', index=index, mtu=1280)
+            ip.nl.addr('add', index, '172.16.0.1', 24)
+            changes = []
+
+            def check():
+                changes.extend(ip.changes_since(version +
+                                                len(changes),
+                                                timeout=0.1))
+                return ('addr', index, {'ipaddr': ('172.16.0.1', 24)}) in \
+                    [x[1:] for x in changes]
+            self._wait(check)
+            assert [x.version for x in changes] == \
+                list(range(version + 1, version + len(changes) + 1))
+            assert [x for x in changes if x.kind == 'link' and
+                    x.key == index and x.diff.get('mtu') == 1280]
+            # routes, that differ only by metric, are kept apart
+            version = ip.version
+            ip.nl.link('set', index=index, state='up')
+            for metric in (10, 20):
+                ip.nl.route('add', prefix='172.16.1.0', mask=24,
+                            gateway='172.16.0.2', priority=metric)
+            ip.nl.route('delete', prefix='172.16.1.0', mask=24,
+                        gateway='172.16.0.2', priority=10)
+            changes = []
+
+            def routes():
+                changes[:] = [x for x in ip.changes_since(version,
+                                                          timeout=0.1)
+                              if x.kind == 'route' and
+                              x.key[2] == '172.16.1.0']
+                return [x for x in changes if x.diff.get('removal')]
+            self._wait(routes)
+            keys = [x.key for x in changes]
+            assert len(set(keys)) == 2
+            assert keys[-1] == keys[0] != keys[1]
+        # the ring is bounded
+        journal = Journal(2)
+        for x in range(3):
+            journal.record('link', x, {})
+        assert journal.since(0) is None
+        assert [x.key for x in journal.since(1)] == [1, 2]
+        assert journal.since(3, timeout=0.1) == []
+
+    def test_wait_for(self):
+        require_user('root')
+        with IPDB() as ip:
+            index = ip.dummyX.index
+            calls = []
+
+            def loopback():
+                calls.append(None)
+                return ip.lo.mtu == 1
+            timer = threading.Timer(0.2, ip.nl.addr,
+                                    ('add', index, '172.16.0.1', 24))
+            timer.start()
+            assert ip.wait_for(lambda: ('172.16.0.1', 24) in
+                               ip.dummyX.ipaddr,
+                               keys=['dummyX'], timeout=3)
+            timer.join()
+            # events of other interfaces do not wake the waiter
+            timer = threading.Timer(0.2, ip.nl.addr,
+                                    ('delete', index, '172.16.0.1', 24))
+            timer.start()
+            assert not ip.wait_for(loopback, keys=['lo'], timeout=1)
+            timer.join()
+            assert len(calls) == 1
+            assert ip.wait_for(lambda: ip.by_name['bala'],
+                               timeout=0.1) is False
+
+    def test_addr_storage(self):
+        index = AddressIndex()
+        index.add('10.0.0.1', 2)
+        index.add('10.0.0.1', 3)
+        index.add('fe80::1', 2)
+        assert index['10.0.0.1'] == set([2, 3])
+        assert index.keys(socket.AF_INET6) == ['fe80::1']
+        index.remove('10.0.0.1', 3)
+        assert index['10.0.0.1'] == set([2])
+        index.remove('10.0.0.1', 2)
+        assert '10.0.0.1' not in index
+        assert index.get('not an address') is None
+        assert len(index) == 1
+        addrs = AddressSet()
+        addrs.add(('10.0.0.1', 24))
+        addrs.add(('fe80::1', 64))
+        assert ('10.0.0.1', 24) in addrs
+        assert ('10.0.0.1', 25) not in addrs
+        assert set(addrs) == set([('10.0.0.1', 24), ('fe80::1', 64)])
+        addrs.remove(('10.0.0.1', 24))
+        assert list(addrs) == [('fe80::1', 64)]
+
+    def test_keep_raw(self):
+        require_user('root')
+        with IPDB() as ip:
+            assert not ip.ipaddr[1].raw
+        with IPDB(keep_raw=True) as ip:
+            assert ip.ipaddr[1].raw[('127.0.0.1', 8)]['index'] == 1
+
+    def test_publish(self):
+        require_user('root')
+        path = '/tmp/ipdb-test-%i.shm' % os.getpid()
+        try:
+            with IPDB() as ip:
+                ip.publish(path, window=0.1)
+                with IPDBView(path) as view:
+                    version = view.version
+                    assert view.lo.mtu == ip.lo.mtu
+                    assert ('127.0.0.1', 8) in view.lo.ipaddr
+                    assert view.by_index[ip.dummyX.index].ifname == 'dummyX'
+                    assert view.routes
+                    ip.nl.addr('add', ip.dummyX.index, '172.16.0.1', 24)
+                    self._wait(lambda: ('172.16.0.1', 24) in
+                               view.dummyX.ipaddr)
+                    assert view.version > version
+        finally:
+            os.unlink(path)
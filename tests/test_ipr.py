@@ -1,12 +1,36 @@
+import io
 import os
+import time
+import errno
+import struct
 import uuid
 import socket
+import threading
+from socket import AF_BRIDGE
+from socket import AF_INET6
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 from pyroute2 import IPRoute
+from pyroute2.common import Coalescer
 from pyroute2.netlink import NetlinkError
+from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink import NLMSG_OVERRUN_PACKET
+from pyroute2.netlink.client import Netlink
+from pyroute2.netlink.iocore import IOCore
+from pyroute2.netlink.iocore import BufferPool
+from pyroute2.netlink.iocore import PooledBuffer
+from pyroute2.netlink.iproute import DumpCache
+from pyroute2.netlink.iproute import RTM_GETLINK
+from pyroute2.netlink.rtnl.ndmsg import ndmsg
+from pyroute2.netlink.rtnl.rtmsg import rtmsg
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
 from multiprocessing import Event
 from multiprocessing import Process
 from utils import grep
 from utils import require_user
+from utils import require_broadcasts
 from utils import get_ip_addr
 from utils import get_ip_link
 from utils import get_ip_route
@@ -158,6 +182,215 @@ def _callback(msg, obj):
     obj.cb_counter += 1
 
 
+def _wait(predicate, timeout=3):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return
+        time.sleep(0.05)
+    raise AssertionError('timeout')
+
+
+class TestCoalescer(object):
+
+    def test_callback_errors(self):
+        calls = []
+
+        def callback(key, data):
+            calls.append(data)
+            if data == 'b':
+                raise ValueError(data)
+
+        coalescer = Coalescer(callback, 0.1)
+        coalescer.push(1, 'a')  # immediate
+        coalescer.push(1, 'b')  # delayed, fails in the thread
+        _wait(lambda: calls == ['a', 'b'] and coalescer.thread is None)
+        # the next window must be delivered by a new thread
+        coalescer.push(1, 'c')
+        coalescer.push(1, 'd')
+        _wait(lambda: calls == ['a', 'b', 'd'])
+
+
+class TestDumpCache(object):
+
+    def test_fdb_keys(self):
+        # FDB records are AF_BRIDGE neighbors without NDA_DST
+        keys = set()
+        for lladdr in ('00:11:22:33:44:55', '00:11:22:33:44:56'):
+            msg = ndmsg()
+            msg['family'] = AF_BRIDGE
+            msg['ifindex'] = 2
+            msg['attrs'] = [['NDA_LLADDR', lladdr]]
+            keys.add(DumpCache.key('neighbors', msg))
+        assert len(keys) == 2
+
+    def test_route_keys(self):
+        # IPv6 routes to one prefix via different nexthops
+        keys = set()
+        for (oif, gateway) in ((2, 'fe80::1'), (2, 'fe80::2'), (3, None)):
+            msg = rtmsg()
+            msg['family'] = AF_INET6
+            msg['dst_len'] = 64
+            msg['table'] = 254
+            msg['attrs'] = [['RTA_DST', '2001:db8::'],
+                            ['RTA_PRIORITY', 1024],
+                            ['RTA_OIF', oif]]
+            if gateway is not None:
+                msg['attrs'].append(['RTA_GATEWAY', gateway])
+            keys.add(DumpCache.key('routes', msg))
+        assert len(keys) == 3
+
+
+class FakeSocket(object):
+    '''
+    Netlink socket stub, that returns prepared datagrams
+    or raises prepared errors, and EAGAIN when empty
+    '''
+    def __init__(self, *items):
+        self.items = list(items)
+
+    def recv_into(self, buf, size, flags=0):
+        if not self.items:
+            raise socket.error(errno.EAGAIN, 'EAGAIN')
+        item = self.items.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        buf[:len(item)] = item
+        return len(item)
+
+
+class FakeQueue(object):
+    '''
+    Buffer queue stub, that stops the consumer when empty
+    '''
+    def __init__(self, stop_event, *items):
+        self.stop_event = stop_event
+        self.items = list(items)
+
+    def get(self):
+        if not self.items:
+            self.stop_event.set()
+            return b''
+        return self.items.pop(0)
+
+
+def _envelope(nonce, data):
+    length = 28 + len(data)
+    return struct.pack('IHHIIIIHH', length, 0, 0, nonce, 0,
+                       0, 0, len(data) + 4, 0) + data
+
+
+class TestBuffers(object):
+
+    def _core(self, pool=None):
+        # only the receive path, w/o threads and sockets
+        core = IOCore.__new__(IOCore)
+        core.pool = pool or BufferPool(size=64)
+        core.queue = Queue.Queue()
+        core.recv_batch = 64
+        return core
+
+    def test_pool(self):
+        pool = BufferPool(size=64, limit=1)
+        buf = pool.get()
+        assert len(buf) == 64
+        pool.put(buf)
+        assert pool.get() is buf
+        # the pool does not grow over the limit
+        pool.put(buf)
+        pool.put(bytearray(64))
+        assert pool.pool == [buf]
+
+    def test_pooled_buffer(self):
+        pool = BufferPool(size=64)
+        buf = pool.get()
+        buf[:5] = b'hello'
+        data = PooledBuffer(pool, buf, 5)
+        assert bytes(data.getvalue()) == b'hello'
+        assert data.read(2) == b'he'
+        assert data.read() == b'llo'
+        data.seek(0)
+        data.write(b'J')
+        assert bytes(data.getvalue()) == b'Jello'
+        # released only once
+        data.release()
+        data.release()
+        assert pool.pool == [buf]
+
+    def test_recv_netlink(self):
+        core = self._core()
+        fd = FakeSocket(b'first', b'second')
+        core.recv_netlink(fd)
+        ret = []
+        while not core.queue.empty():
+            (sock, data) = core.queue.get()
+            assert sock is fd
+            ret.append(bytes(data.getvalue()))
+            data.release()
+        assert ret == [b'first', b'second']
+        # both buffers are back, as well as the one taken
+        # for the EAGAIN attempt
+        assert len(core.pool.pool) == 3
+        core.recv_netlink(FakeSocket(b'third'))
+        assert len(core.pool.pool) == 2
+
+    def test_recv_netlink_overrun(self):
+        core = self._core()
+        fd = FakeSocket(socket.error(errno.ENOBUFS, 'ENOBUFS'), b'data')
+        core.recv_netlink(fd)
+        (sock, data) = core.queue.get()
+        assert data.getvalue() == NLMSG_OVERRUN_PACKET
+        assert data.length == len(NLMSG_OVERRUN_PACKET)
+        (sock, data) = core.queue.get()
+        assert bytes(data.getvalue()) == b'data'
+        assert core.queue.empty()
+
+    def test_recv_netlink_error(self):
+        core = self._core()
+        fd = FakeSocket(socket.error(errno.EBADF, 'EBADF'))
+        try:
+            core.recv_netlink(fd)
+        except socket.error as e:
+            assert e.errno == errno.EBADF
+        else:
+            raise AssertionError('the error is not raised')
+        assert len(core.pool.pool) == 1
+
+    def test_reassemble(self):
+        core = self._core()
+        core.partial = {}
+        envelopes = [_envelope(x, b'data' * x) for x in range(1, 4)]
+        stream = b''.join(envelopes)
+        ret = []
+        # several envelopes in one read, and a split one
+        for chunk in (stream[:70], stream[70:75], stream[75:]):
+            data = io.BytesIO(chunk)
+            ret.extend([x.getvalue() for x in
+                        core.reassemble('fd', data)])
+        assert ret == envelopes
+        assert not core.partial
+
+    def test_feed_buffers(self):
+        envelopes = [_envelope(x, ('message %i' % x).encode('ascii') * 4)
+                     for x in range(4)]
+        stream = b''.join(envelopes)
+        # several envelopes in one buffer, the third one is
+        # split in the header, and the fourth one in the body
+        cut1 = len(b''.join(envelopes[:2])) + 10
+        cut2 = len(b''.join(envelopes[:3])) + 30
+        nl = Netlink.__new__(Netlink)
+        nl._stop_event = threading.Event()
+        nl.buffers = FakeQueue(nl._stop_event,
+                               stream[:cut1],
+                               stream[cut1:cut2],
+                               stream[cut2:])
+        ret = []
+        nl.parse = lambda buf: ret.append(buf.getvalue())
+        nl._feed_buffers()
+        assert ret == [('message %i' % x).encode('ascii') * 4
+                       for x in range(4)]
+
+
 class TestData(object):
 
     def setup(self):
@@ -199,6 +432,92 @@ class TestData(object):
         assert grep('ip route show', pattern='172.16.1.0/24.*172.16.0.1')
         remove_link('bala')
 
+    def test_route_batch(self):
+        require_user('root')
+        create_link('bala', 'dummy')
+        dev = self.ip.link_lookup(ifname='bala')[0]
+        self.ip.link('set', index=dev, state='up')
+        self.ip.addr('add', dev, address='172.16.0.2', mask=24)
+        specs = [{'prefix': '172.16.%i.0' % (x),
+                  'mask': 24,
+                  'gateway': '172.16.0.1'} for x in range(1, 6)]
+        # the last one is a duplicate, it must fail
+        specs.append(specs[0])
+        ret = self.ip.route_batch(specs)
+        assert ret['total'] == 6
+        assert len(ret['errors']) == 1
+        assert ret['errors'][0][0] == 5
+        assert isinstance(ret['errors'][0][2], NetlinkError)
+        assert grep('ip route show', pattern='172.16.5.0/24.*172.16.0.1')
+        for spec in specs[:5]:
+            spec['command'] = 'delete'
+        ret = self.ip.route_batch(specs[:5])
+        assert len(ret['errors']) == 0
+        assert not grep('ip route show', pattern='172.16.5.0/24')
+        remove_link('bala')
+
+    def _getlink_requests(self, indices):
+        for index in indices:
+            msg = ifinfmsg()
+            msg['index'] = index
+            yield (msg, RTM_GETLINK, NLM_F_REQUEST)
+
+    def test_request_batch_errors(self):
+        requests = self._getlink_requests((1, 0x7fffff, 1))
+        ret = self.ip.nlm_request_batch(requests)
+        assert len(ret) == 3
+        assert ret[0][0]['index'] == 1
+        # the error is returned in place and does not abort the batch
+        assert isinstance(ret[1], NetlinkError)
+        assert ret[2][0]['index'] == 1
+
+    def test_request_batch_window(self):
+        state = {'pushed': 0, 'max': 0}
+        push = self.ip.nlm_push_batch
+
+        def push_batch(chunk, *argv, **kwarg):
+            state['pushed'] += len(chunk)
+            state['max'] = max(state['max'], len(chunk))
+            return push(chunk, *argv, **kwarg)
+
+        self.ip.nlm_push_batch = push_batch
+        received = 0
+        for result in self.ip.nlm_request_iter(
+                self._getlink_requests([1] * 20), window=4):
+            # not more than `window` requests in flight
+            assert state['pushed'] - received <= 4
+            received += 1
+        assert received == state['pushed'] == 20
+        assert state['max'] == 4
+
+    def test_request_iter_order(self):
+        indices = [x['index'] for x in self.ip.get_links()]
+        indices.reverse()
+        indices.insert(1, 0x7fffff)
+        ret = []
+        for result in self.ip.nlm_request_iter(
+                self._getlink_requests(indices * 3), window=4):
+            if isinstance(result, NetlinkError):
+                ret.append(0x7fffff)
+            else:
+                ret.append(result[0]['index'])
+        assert ret == indices * 3
+
+    def test_noack(self):
+        require_user('root')
+        dev = self.dev[0]
+        self.ip.noack()
+        self.ip.addr('add', dev, address='172.16.0.1', mask=24)
+        self.ip.addr('add', dev, address='172.16.0.2', mask=24)
+        # duplicate, the only error
+        self.ip.addr('add', dev, address='172.16.0.1', mask=24)
+        errors = self.ip.barrier()
+        assert len(errors) == 1
+        assert isinstance(errors[0][1], NetlinkError)
+        assert '172.16.0.1/24' in get_ip_addr()
+        assert '172.16.0.2/24' in get_ip_addr()
+        assert self.ip.noack(False) == []
+
     def test_updown_link(self):
         require_user('root')
         dev = self.dev[0]
@@ -226,6 +545,72 @@ class TestData(object):
         assert self.cb_counter > 0
         self.ip.unregister_callback(_callback)
 
+    def test_callbacks_window(self):
+        require_user('root')
+        dev = self.dev[0]
+
+        self.cb_counter = 0
+        self.ip.register_callback(_callback,
+                                  lambda x: x.get('index', None) == dev,
+                                  (self, ),
+                                  window=1)
+        self.test_updown_link()
+        # one immediate call, and not more than one delayed
+        _wait(lambda: self.cb_counter >= 1)
+        assert self.cb_counter == 1
+        _wait(lambda: self.cb_counter >= 2)
+        time.sleep(0.5)
+        assert self.cb_counter == 2
+        self.ip.unregister_callback(_callback)
+
+    def test_callbacks_window_removal(self):
+        require_user('root')
+        require_broadcasts(self.ip)
+        create_link('bala', 'dummy')
+        dev = self.ip.link_lookup(ifname='bala')[0]
+        events = []
+
+        def callback(msg):
+            events.append(msg['event'])
+
+        self.ip.monitor()
+        self.ip.register_callback(callback,
+                                  lambda x: x.get('index', None) == dev,
+                                  window=1)
+        self.ip.link('set', index=dev, mtu=1400)
+        self.ip.link('set', index=dev, mtu=1300)
+        self.ip.link_remove(dev)
+        # the removal must not be overtaken by a delayed update
+        _wait(lambda: events and events[-1] == 'RTM_DELLINK')
+        time.sleep(1.5)
+        assert events[-1] == 'RTM_DELLINK'
+        self.ip.unregister_callback(callback)
+        self.ip.monitor(False)
+
+    def test_callbacks_window_routes(self):
+        require_user('root')
+        dev = self.dev[0]
+        routes = []
+
+        def callback(msg):
+            routes.append(msg.get_attr('RTA_DST'))
+
+        # only the first route event is not delayed, but distinct
+        # routes must not override each other
+        self.ip.register_callback(callback,
+                                  lambda x: x.get('dst_len', None) == 24 and
+                                  x.get_attr('RTA_OIF') == dev,
+                                  window=1)
+        self.ip.link('set', index=dev, state='up')
+        self.ip.addr('add', dev, address='172.16.0.2', mask=24)
+        for x in range(1, 4):
+            self.ip.route('add', prefix='172.16.%i.0' % x, mask=24,
+                          gateway='172.16.0.1')
+        _wait(lambda: set(('172.16.1.0',
+                           '172.16.2.0',
+                           '172.16.3.0')) <= set(routes))
+        self.ip.unregister_callback(callback)
+
     def test_callbacks_negative(self):
         require_user('root')
 
@@ -260,13 +645,139 @@ class TestData(object):
     def test_addr(self):
         assert len(get_ip_addr()) == len(self.ip.get_addr())
 
+    def test_addr_index(self):
+        assert len(get_ip_addr(interface='lo')) == \
+            len(self.ip.get_addr(index=1))
+
     def test_links(self):
         assert len(get_ip_link()) == len(self.ip.get_links())
 
+    def test_cache(self):
+        require_user('root')
+        require_broadcasts(self.ip)
+        self.ip.cache()
+        assert len(get_ip_link()) == len(self.ip.get_links())
+        create_link('bala', 'dummy')
+        # the cache is updated asynchronously by broadcasts
+        for _ in range(20):
+            if [x for x in self.ip.get_links()
+                    if x.get_attr('IFLA_IFNAME') == 'bala']:
+                break
+            time.sleep(0.1)
+        else:
+            raise AssertionError('link not found in the cache')
+        assert len(get_ip_link()) == len(self.ip.get_links())
+        self.ip.cache(False)
+
+    def test_cache_unknown_link(self):
+        for operate in (False, True):
+            self.ip.cache(operate)
+            try:
+                self.ip.get_links(1, 0x7fffff)
+            except NetlinkError as e:
+                assert e.code == errno.ENODEV
+            else:
+                raise AssertionError('the error is not raised')
+        self.ip.cache(False)
+
+    def test_cache_link_lookup(self):
+        require_user('root')
+        require_broadcasts(self.ip)
+        self.ip.cache()
+        assert self.ip.link_lookup(ifname='lo') == [1]
+        assert self.ip.link_lookup(ifname='bala') == []
+        create_link('bala', 'dummy')
+        for _ in range(20):
+            if self.ip.link_lookup(ifname='bala'):
+                break
+            time.sleep(0.1)
+        else:
+            raise AssertionError('link not found in the index')
+        idx = self.ip.link_lookup(ifname='bala')
+        addr = self.ip.get_links(*idx)[0].get_attr('IFLA_ADDRESS')
+        assert self.ip.link_lookup(address=addr) == idx
+        remove_link('bala')
+        for _ in range(20):
+            if not self.ip.link_lookup(ifname='bala'):
+                break
+            time.sleep(0.1)
+        else:
+            raise AssertionError('link not removed from the index')
+        self.ip.cache(False)
+
+    def test_concurrent_dumps(self):
+        ret = []
+
+        def dump(num):
+            for _ in range(10):
+                if num % 2:
+                    ret.append(len(self.ip.get_links()))
+                else:
+                    ret.append(len(self.ip.get_addr()))
+
+        stats = dict(self.ip.coalesce_stats)
+        workers = [threading.Thread(target=dump, args=(x, ))
+                   for x in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert len(ret) == 40
+        assert set(ret) == set((len(get_ip_link()), len(get_ip_addr())))
+        assert self.ip.coalesce_stats['dumps'] + \
+            self.ip.coalesce_stats['hits'] - \
+            stats['dumps'] - stats['hits'] == 40
+
+    def test_dump_after_write(self):
+        require_user('root')
+        started = threading.Event()
+        proceed = threading.Event()
+        request = self.ip._nlm_request
+
+        def slow_request(*argv, **kwarg):
+            # hold the first dump answered, but not returned
+            ret = request(*argv, **kwarg)
+            if not started.is_set():
+                started.set()
+                proceed.wait(3)
+            return ret
+
+        self.ip._nlm_request = slow_request
+        worker = threading.Thread(target=self.ip.get_links)
+        worker.start()
+        started.wait(3)
+        create_link('bala', 'dummy')
+        # the dump in progress started before the write,
+        # so this one must not join it
+        timer = threading.Timer(0.5, proceed.set)
+        timer.start()
+        names = [x.get_attr('IFLA_IFNAME') for x in self.ip.get_links()]
+        worker.join()
+        assert 'bala' in names
+
     def test_one_link(self):
         lo = self.ip.get_links(1)[0]
         assert lo.get_attr('IFLA_IFNAME') == 'lo'
 
+    def test_many_links(self):
+        links = [x['index'] for x in self.ip.get_links()]
+        links.reverse()
+        # pipelined requests
+        assert [x['index'] for x in self.ip.get_links(*links)] == links
+        # one dump
+        self.ip.dump_threshold = 0
+        assert [x['index'] for x in self.ip.get_links(*links)] == links
+        try:
+            self.ip.get_links(1, 0xffffff)
+        except NetlinkError:
+            pass
+        else:
+            raise AssertionError('NetlinkError not raised')
+
+    def test_link_lookup(self):
+        assert self.ip.link_lookup(ifname='lo') == [1]
+        assert self.ip.link_lookup(ifname='nonexistent') == []
+
     def test_routes(self):
         assert len(get_ip_route()) == \
             len(self.ip.get_routes(family=socket.AF_INET, table=255))
@@ -18,6 +18,12 @@ def require_user(user):
         raise SkipTest('required user %s' % (user))
 
 
+def require_broadcasts(ip):
+    # broadcasts are not forwarded to remote clients
+    if not ip.host.startswith('netlink://'):
+        raise SkipTest('no broadcasts for %s' % (ip.host))
+
+
 def remove_link(name):
     if os.getuid() != 0:
         return